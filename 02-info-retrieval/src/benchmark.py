@@ -0,0 +1,382 @@
+import argparse
+import configparser
+import csv
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from parsers import indexer, inverted_list, pruning, query, search, evaluate
+import parsers.shards
+import utils.synthetic
+
+# The parsers log every step, which would be timed too, so only their warnings are shown.
+logging.basicConfig(
+    format="%(levelname)s: %(message)s",
+    level=logging.WARNING
+)
+logger = logging.getLogger("benchmark")
+logger.setLevel(logging.INFO)
+
+
+def __peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if platform.system() == "Darwin" else 1024)
+
+
+def __latencies(latencies: List[float]) -> Dict[str, float]:
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def __directory_mb(path: str) -> float:
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names) / (1024 * 1024)
+
+
+def __run_phase(function: Callable, *args) -> Dict:
+    """
+    Run a phase in a new process, so that its peak RSS is measured on its own.
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function, *args).result()
+
+
+def __fastest_phase(repeat: int, function: Callable, *args) -> Dict:
+    runs = [__run_phase(function, *args) for _ in range(repeat)]
+    return min(runs, key=lambda measures: measures["seconds"])
+
+
+def __inverted_list_phase(documents_paths: List[str], workdir: str, steemer: bool, workers: int) -> Dict:
+    start = time.perf_counter()
+    postings, max_freq_in_document = inverted_list.parse(
+        documents_paths, os.path.join(workdir, "lista.csv"), steemer=steemer, workers=workers)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "documents": len(max_freq_in_document),
+        "terms": len(postings),
+        "documents_per_second": len(max_freq_in_document) / seconds,
+        "peak_rss_mb": __peak_rss_mb(),
+    }
+
+
+def __index_phase(documents_paths: List[str], workdir: str, steemer: bool, workers: int, memory_budget: int, shards: int) -> Dict:
+    model_path = os.path.join(workdir, "modelo")
+    start = time.perf_counter()
+    indexer.write_model(documents_paths, os.path.join(workdir, "lista.csv"), model_path,
+                        steemer=steemer, workers=workers, memory_budget=memory_budget, shards=shards)
+    seconds = time.perf_counter() - start
+    models = search.open_model(model_path)
+    n_documents = sum(model.n_documents for model in models)
+    return {
+        "seconds": seconds,
+        "documents": n_documents,
+        "terms": len(parsers.shards.statistics(model_path)[0]) if shards > 1 else len(models[0].terms),
+        "postings": sum(int(model.offsets[-1]) for model in models),
+        "model_mb": __directory_mb(model_path),
+        "documents_per_second": n_documents / seconds,
+        "peak_rss_mb": __peak_rss_mb(),
+    }
+
+
+def __search_phase(queries_path: str, workdir: str, top_k: int, search_workers: int, name: str = "") -> Dict:
+    """
+    Time the batch search of the whole queries file, then every query alone against a model
+    that is already open, for the latency of a single query.
+    """
+    model_path = os.path.join(workdir, "modelo" + name)
+    results_path = os.path.join(workdir, f"resultados{name}.csv")
+    start = time.perf_counter()
+    search.retrieve_documents(queries_path, results_path, model_path, top_k=top_k, workers=search_workers)
+    seconds = time.perf_counter() - start
+
+    models = search.open_model(model_path)
+    with open(queries_path, "r", encoding="utf-8") as file:
+        queries = [row["QueryText"].split() for row in csv.DictReader(file, delimiter=";")]
+    latencies = []
+    for terms in queries:
+        query_start = time.perf_counter()
+        search.search(terms, models, top_k)
+        latencies.append(time.perf_counter() - query_start)
+
+    return dict({
+        "seconds": seconds,
+        "queries": len(queries),
+        "queries_per_second": len(queries) / seconds,
+        "peak_rss_mb": __peak_rss_mb(),
+    }, **__latencies(latencies))
+
+
+def __evaluate_phase(results_path: str, expected_path: str, workdir: str, max_results: int, label: str = "BENCHMARK") -> Dict:
+    # The metrics write to ./avalia, so they run from the working directory.
+    os.chdir(workdir)
+    os.makedirs("./avalia", exist_ok=True)
+    start = time.perf_counter()
+    run = evaluate.EvaluationRun(results_path, expected_path, label)
+    loaded = time.perf_counter()
+    evaluate.f1_score(run, max_results)
+    precisions = evaluate.precision_at_n(run, 10)
+    mean_average_precision = evaluate.mean_average_precision(run, max_results)
+    evaluate.mean_reciprocal_rank(run, 10, max_results)
+    evaluate.discounted_cumulative_gain(run, max_results)
+    ndcgs = evaluate.normalized_dicounted_comulative_gain(run, max_results)
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "load_seconds": loaded - start,
+        "queries": len(run.queries),
+        "map": mean_average_precision,
+        "p@10": float(np.mean(list(precisions.values()))),
+        "ndcg": float(np.mean(list(ndcgs.values()))),
+        "peak_rss_mb": __peak_rss_mb(),
+    }
+
+
+def __prune_phase(workdir: str, shards: int, method: str, level: float, name: str) -> Dict:
+    """
+    Prune a copy of the model (see `parsers.pruning`), every shard of it when it is sharded.
+    """
+    model_path, pruned_path = os.path.join(workdir, "modelo"), os.path.join(workdir, "modelo" + name)
+    start = time.perf_counter()
+    if shards > 1:
+        shutil.rmtree(pruned_path, ignore_errors=True)
+        shutil.copytree(model_path, pruned_path)
+        stats = [pruning.prune(path, path, method, level) for path in parsers.shards.shard_paths(pruned_path)]
+    else:
+        stats = [pruning.prune(model_path, pruned_path, method, level)]
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "postings": sum(shard["kept_postings"] for shard in stats),
+        "model_mb": __directory_mb(pruned_path),
+        "peak_rss_mb": __peak_rss_mb(),
+    }
+
+
+def __commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(documents_paths: List[str], queries_path: str, workdir: str, steemer: bool = False, workers: int = 1, top_k: int = 100, max_results: int = 10, repeat: int = 1, memory_budget: int = None, search_workers: int = 1, shards: int = 1) -> Dict:
+    """
+    Benchmark the building of the inverted list, the indexer, the search and the evaluation
+    of a collection, each in its own process.
+
+    Args:
+    - documents_paths (List[str]): the XML files with the documents
+    - queries_path (str): the XML file with the queries and their expected documents
+    - workdir (str): the directory where the intermediate files are written
+    - steemer (bool): whether to stem the terms
+    - workers (int): the number of processes used to parse the documents files
+    - top_k (int): how many documents are retrieved per query
+    - max_results (int): the MAX of the evaluation
+    - repeat (int): how many times each phase is run. The fastest run is kept
+    - memory_budget (int): if given, the index is built from runs of at most this many megabytes (see `parsers.spimi`)
+    - search_workers (int): the number of processes that score the queries file
+    - shards (int): if more than 1, the index is split in this many shards, searched by one process each (see `parsers.shards`)
+
+    Returns:
+    - Dict: the measures of each phase
+    """
+    parsed_queries_path = os.path.join(workdir, "consultas.csv")
+    expected_path = os.path.join(workdir, "esperados.csv")
+    query.parse(queries_path, parsed_queries_path, expected_path, steemer=steemer)
+
+    phases = {
+        "inverted_list": (__inverted_list_phase, documents_paths, workdir, steemer, workers),
+        "index": (__index_phase, documents_paths, workdir, steemer, workers, memory_budget, shards),
+        "search": (__search_phase, parsed_queries_path, workdir, top_k, search_workers),
+        "evaluate": (__evaluate_phase, os.path.join(workdir, "resultados.csv"), expected_path, workdir, max_results),
+    }
+    results = {}
+    for name, (function, *args) in phases.items():
+        logger.info("BENCHMARK - Running %s", name)
+        results[name] = __fastest_phase(repeat, function, *args)
+    return results
+
+
+def prune_report(workdir: str, phases: Dict, method: str, levels: List[float], shards: int = 1, top_k: int = 100, max_results: int = 10, search_workers: int = 1, repeat: int = 1) -> Dict:
+    """
+    Measure how much of the index can be pruned (see `parsers.pruning`) before the quality
+    of the results drops: the model benchmarked by `run` is pruned at each level, searched
+    and evaluated again, and its size, query latency, MAP, P@10 and nDCG are compared with
+    the ones of the full model.
+
+    Args:
+    - workdir (str): the working directory of `run`, with its model, queries and expected documents
+    - phases (Dict): the measures returned by `run`, for the full model
+    - method (str): the pruning method, "term", "document" or "threshold"
+    - levels (List[float]): the fractions of postings to keep, or the impact thresholds
+    - shards, top_k, max_results, search_workers, repeat: the options given to `run`
+
+    Returns:
+    - Dict: the measures of the full model and of the model pruned at each level, each one
+      with its ratio to the full model
+    """
+    full = {
+        "postings": phases["index"]["postings"],
+        "model_mb": phases["index"]["model_mb"],
+        "mean_ms": phases["search"]["mean_ms"],
+        "map": phases["evaluate"]["map"],
+        "p@10": phases["evaluate"]["p@10"],
+        "ndcg": phases["evaluate"]["ndcg"],
+    }
+    report = {"method": method, "full": full, "levels": []}
+    for level in levels:
+        name = f"-{method}-{level:g}"
+        logger.info("BENCHMARK - Running %s pruning at %g", method, level)
+        pruned = __fastest_phase(repeat, __prune_phase, workdir, shards, method, level, name)
+        searched = __fastest_phase(repeat, __search_phase, os.path.join(workdir, "consultas.csv"), workdir,
+                                   top_k, search_workers, name)
+        evaluated = __run_phase(__evaluate_phase, os.path.join(workdir, f"resultados{name}.csv"),
+                                os.path.join(workdir, "esperados.csv"), workdir, max_results, name[1:])
+        measures = {
+            "postings": pruned["postings"],
+            "model_mb": pruned["model_mb"],
+            "mean_ms": searched["mean_ms"],
+            "map": evaluated["map"],
+            "p@10": evaluated["p@10"],
+            "ndcg": evaluated["ndcg"],
+        }
+        ratios = {f"{key}_ratio": value / full[key] if full[key] else 0.0 for key, value in measures.items()}
+        report["levels"].append(dict({"level": level, "prune_seconds": pruned["seconds"],
+                                      "p50_ms": searched["p50_ms"]}, **measures, **ratios))
+        logger.info("BENCHMARK - %s pruning at %g: %.1f%% of the postings, %.1f%% of the size, %.1f%% of the "
+                    "latency, MAP %.3f (%.1f%%), P@10 %.3f (%.1f%%), nDCG %.3f (%.1f%%)",
+                    method, level, 100 * ratios["postings_ratio"], 100 * ratios["model_mb_ratio"],
+                    100 * ratios["mean_ms_ratio"], measures["map"], 100 * ratios["map_ratio"],
+                    measures["p@10"], 100 * ratios["p@10_ratio"], measures["ndcg"], 100 * ratios["ndcg_ratio"])
+    return report
+
+
+def compare(results: Dict, baseline: Dict) -> None:
+    """
+    Log the ratio between the times of two benchmarks, phase by phase.
+    """
+    for phase, measures in results["phases"].items():
+        if phase in baseline.get("phases", {}):
+            ratio = measures["seconds"] / baseline["phases"][phase]["seconds"]
+            logger.info("BENCHMARK - %s: %.3f s, %.2fx the baseline (%.3f s)",
+                        phase, measures["seconds"], ratio, baseline["phases"][phase]["seconds"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the indexing, search and evaluation of the bundled CFC collection or of a synthetic one")
+    parser.add_argument("--config-index", type=str, default="./config/index.cfg",
+                        help="Sets the config file with the documents files of the CFC collection (LEIA)")
+    parser.add_argument("--config-pc", type=str, default="./config/pc.cfg",
+                        help="Sets the config file with the queries file of the CFC collection (LEIA)")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Benchmarks a synthetic collection with this many documents instead of the CFC collection")
+    parser.add_argument("--synthetic-queries", type=int, default=1000,
+                        help="Sets how many queries the synthetic collection has")
+    parser.add_argument("--vocabulary", type=int, default=50000,
+                        help="Sets how many distinct words the synthetic collection has")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Sets the seed of the synthetic collection")
+    parser.add_argument("--steemer", action="store_true",
+                        help="Stems the terms")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Sets how many processes parse the documents files")
+    parser.add_argument("--memory-budget", type=int, default=None,
+                        help="Builds the index from sorted runs of at most this many megabytes")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Splits the index in this many shards, searched by one process each")
+    parser.add_argument("--search-workers", type=int, default=1,
+                        help="Sets how many processes score the queries")
+    parser.add_argument("--top-k", type=int, default=100,
+                        help="Sets how many documents are retrieved per query")
+    parser.add_argument("--prune", choices=pruning.METHODS, default=None,
+                        help="Compares the index pruned with this method at every --prune-levels with the full index")
+    parser.add_argument("--prune-levels", type=float, nargs="+", default=None,
+                        help="Sets the fractions of the postings of each term or document kept by the pruning (by default 0.9, 0.75, 0.5, 0.25 and 0.1), or the smallest impacts kept by --prune threshold, which needs them. The impact of a posting is its TF-IDF weight divided by the norm of its document, from 0 to 1")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs each phase this many times and keeps the fastest")
+    parser.add_argument("--workdir", type=str, default=None,
+                        help="Keeps the generated and intermediate files in this directory instead of a temporary one")
+    parser.add_argument("--output", type=str, default="./benchmark.json",
+                        help="Sets the JSON file the results are saved to")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Compares the results with a JSON file saved by a previous benchmark")
+    args = parser.parse_args()
+    if args.prune == "threshold" and args.prune_levels is None:
+        parser.error("--prune threshold needs --prune-levels")
+    if args.prune_levels is None:
+        args.prune_levels = [0.9, 0.75, 0.5, 0.25, 0.1]
+    if args.prune != "threshold" and not all(0 < level <= 1 for level in args.prune_levels):
+        parser.error("--prune-levels must be above 0 and at most 1 with --prune term or document")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    config = configparser.ConfigParser()
+    config.read(args.config_index)
+    cfc_documents_paths = [path.strip() for path in config["NOSTEEMER"]["LEIA"].split(",") if path.strip()]
+    config.read(args.config_pc)
+    cfc_queries_path = config["NOSTEEMER"]["LEIA"]
+
+    corpus = {"name": "cfc"}
+    if args.synthetic:
+        start = time.perf_counter()
+        documents_paths, queries_path = utils.synthetic.write_collection(
+            os.path.join(workdir, "raw"), cfc_documents_paths, args.synthetic, args.synthetic_queries,
+            vocabulary_size=args.vocabulary, seed=args.seed)
+        corpus = {"name": "synthetic", "documents": args.synthetic, "queries": args.synthetic_queries,
+                  "vocabulary": args.vocabulary, "seed": args.seed,
+                  "generation_seconds": time.perf_counter() - start}
+    else:
+        documents_paths, queries_path = cfc_documents_paths, cfc_queries_path
+    documents_paths = [os.path.abspath(path) for path in documents_paths]
+    queries_path = os.path.abspath(queries_path)
+
+    try:
+        phases = run(documents_paths, queries_path, os.path.abspath(workdir), steemer=args.steemer,
+                     workers=args.workers, top_k=args.top_k, repeat=args.repeat, memory_budget=args.memory_budget,
+                     search_workers=args.search_workers, shards=args.shards)
+        report = prune_report(os.path.abspath(workdir), phases, args.prune, args.prune_levels, shards=args.shards,
+                              top_k=args.top_k, search_workers=args.search_workers,
+                              repeat=args.repeat) if args.prune else None
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "commit": __commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "corpus": corpus,
+        "options": {"steemer": args.steemer, "workers": args.workers, "top_k": args.top_k, "repeat": args.repeat,
+                    "memory_budget": args.memory_budget, "search_workers": args.search_workers,
+                    "shards": args.shards, "prune": args.prune,
+                    "prune_levels": args.prune_levels if args.prune else None},
+        "phases": phases,
+    }
+    if report is not None:
+        results["pruning"] = report
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            compare(results, json.load(file))
@@ -1,17 +1,113 @@
 import argparse
 import configparser
 import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Tuple
 
 import matplotlib.pyplot as plt
 
-from parsers import indexer, inverted_list, query, search, evaluate
+from parsers import indexer, inverted_list, pruning, query, search, segments, shards, server, evaluate
+import utils
+import utils.instrumentation
+import utils.stages
 
 logging.basicConfig(
     format="%(levelname)s: %(message)s",
     level=logging.INFO
 )
 
-config = configparser.ConfigParser()
+SOURCES_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# The source files each stage depends on, so a change to the code of a stage runs it again.
+STAGE_SOURCES = {
+    "pc": ["parsers/query.py", "parsers/reader.py", "utils/__init__.py", "utils/stopwords.txt"],
+    "gli": ["parsers/inverted_list.py", "parsers/reader.py", "utils/__init__.py", "utils/stopwords.txt"],
+    "index": ["parsers/indexer.py", "parsers/inverted_list.py", "parsers/spimi.py", "parsers/shards.py",
+              "parsers/pruning.py", "parsers/model.py", "parsers/vocabulary.py", "parsers/compression.py",
+              "parsers/reader.py", "utils/__init__.py", "utils/stopwords.txt"],
+    "busca": ["parsers/search.py", "parsers/model.py", "parsers/vocabulary.py", "parsers/compression.py",
+              "parsers/segments.py", "parsers/shards.py"],
+    "avaliacao": ["parsers/evaluate.py", "utils/__init__.py"],
+}
+
+# The colors of the variants in the evaluation plots, in the order of their sections.
+COLORS = ["red", "blue", "green", "orange", "purple", "brown", "pink", "gray"]
+
+
+def __sources(stage: str) -> List[str]:
+    return [os.path.join(SOURCES_PATH, path) for path in STAGE_SOURCES[stage]]
+
+
+def __split_paths(paths: str) -> List[str]:
+    return list(filter(lambda path: path.strip() != "", paths.split(",")))
+
+
+def __read_config(path: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def __steemer(section: configparser.SectionProxy) -> bool:
+    """
+    Whether a variant is stemmed: its STEEMER key, or else whether the section is named STEEMER.
+    """
+    return section.getboolean("STEEMER", fallback=section.name == "STEEMER")
+
+
+def __run_variants(function: Callable, arguments: List[Tuple], workers: int) -> List:
+    """
+    Call `function` once per variant, with up to `workers` variants in parallel processes.
+    The measures taken in those processes are added to the ones of this process.
+    """
+    if workers <= 1 or len(arguments) <= 1:
+        return [function(*variant_arguments) for variant_arguments in arguments]
+    results = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(arguments))) as executor:
+        for result, measures in executor.map(utils.instrumentation.capture, [function] * len(arguments), *zip(*arguments)):
+            utils.instrumentation.merge(measures)
+            results.append(result)
+    return results
+
+
+def __variant_workers(variant_workers: int, variants: List[str]) -> int:
+    return variant_workers or min(len(variants), os.cpu_count() or 1)
+
+
+def __shared_postings(documents_paths: Dict[str, List[str]], workers: int) -> Dict[str, Tuple]:
+    """
+    Tokenize once the documents read by more than one variant. The unstemmed inverted list is
+    shared by those variants, and the stemmed ones derive their view from it.
+    """
+    variants_by_documents = defaultdict(list)
+    for variant, paths in documents_paths.items():
+        variants_by_documents[tuple(path.strip() for path in paths)].append(variant)
+
+    postings = {}
+    for paths, variants in variants_by_documents.items():
+        if len(variants) > 1:
+            shared = inverted_list.build(list(paths), steemer=False, workers=workers)
+            postings.update((variant, shared) for variant in variants)
+    return postings
+
+
+def __write_variant(documents_paths: List[str], inverted_list_path: str, model_path: str, json_path: str, steemer: bool, postings: Tuple, workers: int, memory_budget: int = None, shards: int = 1, partition: str = "range", prune: str = None, prune_level: float = 0.5, prune_threshold: float = None) -> None:
+    """
+    Write the inverted list of a variant and, when it has a `model_path`, its model.
+    """
+    if postings is not None and steemer:
+        postings = inverted_list.stemmed_view(postings[0])
+    if model_path is None:
+        inverted_list.parse(documents_paths, inverted_list_path, steemer=steemer,
+                            workers=workers, postings=postings)
+    else:
+        indexer.write_model(
+            documents_paths, inverted_list_path, model_path, steemer=steemer,
+            output_path_json=json_path, workers=workers, postings=postings, memory_budget=memory_budget,
+            shards=shards, partition=partition, prune=prune, prune_level=prune_level,
+            prune_threshold=prune_threshold)
 
 
 def main(**kwargs) -> None:
@@ -22,13 +118,23 @@ def main(**kwargs) -> None:
     The tasks performed by the function include parsing queries, creating an inverted list, running an indexer, and searching for results.
     The function reads configuration files to obtain the necessary input data for each task.
 
+    Every section of a configuration file is a variant of the system, such as NOSTEEMER and STEEMER. A variant is stemmed when its STEEMER key is true, or when it has no such key and its section is named STEEMER. The variants of each stage run in parallel processes, up to 'variant_workers' at a time (by default as many as there are variants and CPUs), and the variants that index the same documents share a single tokenization of them.
+
+    The stages pc, gli, index, busca and avaliacao only run when they are out of date: each one records the content hashes of its inputs, configuration file, source code and outputs in a state file ('state'), and is skipped when none of them changed (see `utils.stages.StageCache`). The 'force' option runs the given stages, or every stage when none is given, regardless.
+
     If the 'parse_queries' flag is True, the function reads a configuration file to obtain query-related paths and passes them to the `parse` function from a `query` module.
 
     If the 'create_inverted_list' flag is True and the 'run_indexer' flag is False, the function reads a configuration file to obtain document-related paths and passes them to the `parse` function from an `inverted_list` module.
 
-    If the 'run_indexer' flag is True, the function reads two configuration files to obtain document-related and index-related paths, and passes them to the `write_model` function from an `indexer` module.
+    If the 'run_indexer' flag is True, the function reads two configuration files to obtain document-related and index-related paths, and passes them to the `write_model` function from an `indexer` module. The model is also exported as JSON when the index configuration has a JSON path. With a 'memory_budget' (in megabytes), the model is built from sorted runs merged on disk (see `parsers.spimi`), so the collection does not need to fit in memory. With more than one of 'shards', the documents are split in that many shards by 'partition' (see `parsers.shards`), and the search sends every query to all of them and merges their results. With a 'prune' method, the postings with the smallest impact are dropped from the model once written, keeping the 'prune_level' fraction of them per term or document, or the ones whose impact is at least 'prune_threshold' (see `parsers.pruning`).
+
+    If 'add_documents', 'delete_documents' or 'merge_segments' are given, the function reads the index configuration file to obtain the incremental index of each variant (INDICE) and adds the documents of the given files to it, tombstones the given record numbers, or merges its segments. The search uses the index when MODELO points to it.
+
+    If the 'search' flag is True, the function reads a configuration file to obtain model-related, query-related, and result-related paths, and retrieves the top 'top_k' documents (TOP_K in the configuration file) for every query, with the queries split among 'search_workers' processes that share the memory-mapped model.
 
-    If the 'search' flag is True, the function reads a configuration file to obtain model-related, query-related, and result-related paths, and prints the values of these paths.
+    If a 'query' is given, the function ranks the documents of the model of each variant (MODELO in busca) for it and prints the top 'top_k' (10 by default).
+
+    If the 'serve' flag is True, the function opens the model of each variant once and serves queries over HTTP (see `parsers.server`) until interrupted.
 
     Args:
         **kwargs: Keyword arguments to control the behavior of the function.
@@ -37,146 +143,187 @@ def main(**kwargs) -> None:
         None
     """
     logging.info("Program started")
+    stages = utils.stages.StageCache(kwargs["state"], kwargs["force"])
+
     if kwargs["parse_queries"]:
-        config.read(kwargs["config_pc"])
-        queries_path = config["NOSTEEMER"]["LEIA"]
-        parsed_queries_path = config["NOSTEEMER"]["CONSULTAS"]
-        expected_path = config["NOSTEEMER"]["ESPERADOS"]
-        query.parse(queries_path, parsed_queries_path,
-                    expected_path, steemer=False)
-
-        queries_path = config["STEEMER"]["LEIA"]
-        parsed_queries_path = config["STEEMER"]["CONSULTAS"]
-        expected_path = config["STEEMER"]["ESPERADOS"]
-        query.parse(queries_path, parsed_queries_path,
-                    expected_path, steemer=True)
+        config = __read_config(kwargs["config_pc"])
+        variants = config.sections()
+        variant_workers = __variant_workers(kwargs["variant_workers"], variants)
+
+        def parse_queries() -> None:
+            __run_variants(query.parse, [
+                (config[variant]["LEIA"], config[variant]["CONSULTAS"],
+                 config[variant]["ESPERADOS"], __steemer(config[variant]))
+                for variant in variants
+            ], variant_workers)
+
+        stages.run(
+            "pc", parse_queries,
+            inputs=[kwargs["config_pc"], *(config[variant]["LEIA"] for variant in variants), *__sources("pc")],
+            outputs=[path for variant in variants
+                     for path in (config[variant]["CONSULTAS"], config[variant]["ESPERADOS"])])
 
     if kwargs["create_inverted_list"] and not kwargs["run_indexer"]:
-        config.read(kwargs["config_gli"])
-        documents_paths = config["NOSTEEMER"]["LEIA"]
-        inverted_list_path = config["NOSTEEMER"]["ESCREVA"]
-        documents_paths = documents_paths.split(",")
-        documents_paths = list(
-            filter(lambda document_path: document_path.strip()
-                   != "", documents_paths)
-        )
-        inverted_list.parse(documents_paths, inverted_list_path, steemer=False)
-
-        documents_paths = config["STEEMER"]["LEIA"]
-        inverted_list_path = config["STEEMER"]["ESCREVA"]
-        documents_paths = documents_paths.split(",")
-        documents_paths = list(
-            filter(lambda document_path: document_path.strip()
-                   != "", documents_paths)
-        )
-        inverted_list.parse(documents_paths, inverted_list_path, steemer=True)
+        config = __read_config(kwargs["config_gli"])
+        variants = config.sections()
+        variant_workers = __variant_workers(kwargs["variant_workers"], variants)
+        documents_paths = {variant: __split_paths(config[variant]["LEIA"]) for variant in variants}
+
+        def create_inverted_list() -> None:
+            postings = __shared_postings(documents_paths, kwargs["workers"])
+            __run_variants(__write_variant, [
+                (documents_paths[variant], config[variant]["ESCREVA"], None, None,
+                 __steemer(config[variant]), postings.get(variant), kwargs["workers"])
+                for variant in variants
+            ], variant_workers)
+
+        stages.run(
+            "gli", create_inverted_list,
+            inputs=[kwargs["config_gli"], *(path for paths in documents_paths.values() for path in paths),
+                    *__sources("gli")],
+            outputs=[config[variant]["ESCREVA"] for variant in variants])
 
     if kwargs["run_indexer"]:
-        config.read(kwargs["config_gli"])
-        inverted_list_path = config["NOSTEEMER"]["ESCREVA"]
-
-        config.read(kwargs["config_index"])
-        documents_paths = config["NOSTEEMER"]["LEIA"]
-        model_path = config["NOSTEEMER"]["ESCREVA"]
-        documents_paths = documents_paths.split(",")
-        documents_paths = list(
-            filter(lambda input_path: input_path.strip() != "", documents_paths)
-        )
-        indexer.write_model(
-            documents_paths, inverted_list_path, model_path, steemer=False)
-
-        config.read(kwargs["config_gli"])
-        inverted_list_path = config["STEEMER"]["ESCREVA"]
-
-        config.read(kwargs["config_index"])
-        documents_paths = config["STEEMER"]["LEIA"]
-        model_path = config["STEEMER"]["ESCREVA"]
-        documents_paths = documents_paths.split(",")
-        documents_paths = list(
-            filter(lambda input_path: input_path.strip() != "", documents_paths)
-        )
-        indexer.write_model(
-            documents_paths, inverted_list_path, model_path, steemer=True)
+        gli_config = __read_config(kwargs["config_gli"])
+        config = __read_config(kwargs["config_index"])
+        variants = config.sections()
+        variant_workers = __variant_workers(kwargs["variant_workers"], variants)
+        documents_paths = {variant: __split_paths(config[variant]["LEIA"]) for variant in variants}
+        outputs = [path for variant in variants
+                   for path in (gli_config[variant]["ESCREVA"], config[variant]["ESCREVA"], config[variant].get("JSON"))
+                   if path]
+
+        def run_indexer() -> None:
+            # With a memory budget, each variant builds its model from runs on disk instead.
+            postings = {} if kwargs["memory_budget"] else __shared_postings(documents_paths, kwargs["workers"])
+            __run_variants(__write_variant, [
+                (documents_paths[variant], gli_config[variant]["ESCREVA"], config[variant]["ESCREVA"],
+                 config[variant].get("JSON"), __steemer(config[variant]), postings.get(variant), kwargs["workers"],
+                 kwargs["memory_budget"], kwargs["shards"], kwargs["partition"], kwargs["prune"], kwargs["prune_level"],
+                 kwargs["prune_threshold"])
+                for variant in variants
+            ], variant_workers)
+
+        stages.run(
+            "index", run_indexer,
+            inputs=[kwargs["config_gli"], kwargs["config_index"],
+                    *(path for paths in documents_paths.values() for path in paths), *__sources("index")],
+            outputs=outputs, params={"memory_budget": kwargs["memory_budget"], "shards": kwargs["shards"],
+                                     "partition": kwargs["partition"], "prune": kwargs["prune"],
+                                     "prune_level": kwargs["prune_level"], "prune_threshold": kwargs["prune_threshold"]})
+
+    if kwargs["add_documents"] or kwargs["delete_documents"] or kwargs["merge_segments"]:
+        config = __read_config(kwargs["config_index"])
+        for variant in config.sections():
+            index_path = config[variant]["INDICE"]
+            if kwargs["delete_documents"]:
+                segments.delete_documents(index_path, kwargs["delete_documents"])
+            if kwargs["add_documents"]:
+                segments.add_documents(index_path, kwargs["add_documents"], steemer=__steemer(config[variant]),
+                                       workers=kwargs["workers"])
+            if kwargs["merge_segments"]:
+                segments.merge_segments(index_path)
 
     if kwargs["search"]:
-        config.read(kwargs["config_busca"])
-        queries_path = config["NOSTEEMER"]["CONSULTAS"]
-        results_path = config["NOSTEEMER"]["RESULTADOS"]
-        model_path = config["NOSTEEMER"]["MODELO"]
-        search.retrieve_documents(
-            queries_path, results_path, model_path, steemer=False)
-
-        queries_path = config["STEEMER"]["CONSULTAS"]
-        results_path = config["STEEMER"]["RESULTADOS"]
-        model_path = config["STEEMER"]["MODELO"]
-        search.retrieve_documents(
-            queries_path, results_path, model_path, steemer=True)
+        config = __read_config(kwargs["config_busca"])
+        variants = config.sections()
+        variant_workers = __variant_workers(kwargs["variant_workers"], variants)
+        top_k = {
+            variant: kwargs["top_k"] if kwargs["top_k"] is not None else config[variant].getint("TOP_K", fallback=0)
+            for variant in variants
+        }
+        run_format = {
+            variant: kwargs["run_format"] or config[variant].get("FORMATO", fallback="csv")
+            for variant in variants
+        }
+
+        def run_search() -> None:
+            __run_variants(search.retrieve_documents, [
+                (config[variant]["CONSULTAS"], config[variant]["RESULTADOS"], config[variant]["MODELO"],
+                 top_k[variant], kwargs["max_score"], kwargs["batch_search"], run_format[variant],
+                 kwargs["search_workers"])
+                for variant in variants
+            ], variant_workers)
+
+        stages.run(
+            "busca", run_search,
+            inputs=[kwargs["config_busca"],
+                    *(path for variant in variants
+                      for path in (config[variant]["CONSULTAS"], config[variant]["MODELO"])),
+                    *__sources("busca")],
+            outputs=[config[variant]["RESULTADOS"] for variant in variants],
+            params={"top_k": top_k, "run_format": run_format,
+                    "max_score": kwargs["max_score"], "batch_search": kwargs["batch_search"]})
 
     if kwargs["evaluate"]:
-        config.read(kwargs["config_avaliacao"])
-        NOSTEEMER_expected_path = config["NOSTEEMER"]["ESPERADOS"]
-        NOSTEEMER_retrieved_path = config["NOSTEEMER"]["RESULTADOS"]
-        NOSTEEMER_max_results = int(config["NOSTEEMER"]["MAX"])
-
-        STEEMER_expected_path = config["STEEMER"]["ESPERADOS"]
-        STEEMER_retrieved_path = config["STEEMER"]["RESULTADOS"]
-        STEEMER_max_results = int(config["STEEMER"]["MAX"])
-
-        max_results = max(NOSTEEMER_max_results, STEEMER_max_results)
-
-        evaluate.interpoloated_average_precision_11_point_graph(
-            NOSTEEMER_retrieved_path, NOSTEEMER_expected_path, "NOSTEEMER", "red"
-        )
-        evaluate.interpoloated_average_precision_11_point_graph(
-            STEEMER_retrieved_path, STEEMER_expected_path, "STEEMER", "blue"
-        )
-        plt.legend()
-        plt.savefig("./avalia/11pontos.jpeg")
-        plt.clf()
-
-        evaluate.f1_score(NOSTEEMER_retrieved_path, NOSTEEMER_expected_path,
-                          "NOSTEEMER", max_results)
-        evaluate.f1_score(STEEMER_retrieved_path, STEEMER_expected_path,
-                          "STEEMER", max_results)
-
-        evaluate.precision_at_n(NOSTEEMER_retrieved_path,
-                                NOSTEEMER_expected_path, 5, "NOSTEEMER")
-        evaluate.precision_at_n(STEEMER_retrieved_path,
-                                STEEMER_expected_path, 5, "STEEMER")
-
-        evaluate.precision_at_n(NOSTEEMER_retrieved_path,
-                                NOSTEEMER_expected_path, 10, "NOSTEEMER")
-        evaluate.precision_at_n(STEEMER_retrieved_path,
-                                STEEMER_expected_path, 10, "STEEMER")
-
-        evaluate.r_precision_histogram(
-            [NOSTEEMER_retrieved_path, STEEMER_retrieved_path],
-            [NOSTEEMER_expected_path, STEEMER_expected_path],
-            max_results,
-            ["NOSTEEMER", "STEEMER"]
-        )
-        plt.savefig("./avalia/histograma.jpeg")
-        plt.clf()
-
-        evaluate.mean_average_precision(
-            NOSTEEMER_retrieved_path, NOSTEEMER_expected_path, max_results, "NOSTEEMER")
-        evaluate.mean_average_precision(
-            STEEMER_retrieved_path, STEEMER_expected_path, max_results, "STEEMER")
-
-        evaluate.mean_reciprocal_rank(
-            NOSTEEMER_retrieved_path, NOSTEEMER_expected_path, 10, max_results, "NOSTEEMER")
-        evaluate.mean_reciprocal_rank(
-            STEEMER_retrieved_path, STEEMER_expected_path, 10, max_results, "STEEMER")
-
-        evaluate.discounted_cumulative_gain(
-            NOSTEEMER_retrieved_path, NOSTEEMER_expected_path, max_results, "NOSTEEMER")
-        evaluate.discounted_cumulative_gain(
-            STEEMER_retrieved_path, STEEMER_expected_path, max_results, "STEEMER")
-
-        evaluate.normalized_dicounted_comulative_gain(
-            NOSTEEMER_retrieved_path, NOSTEEMER_expected_path, max_results, "NOSTEEMER")
-        evaluate.normalized_dicounted_comulative_gain(
-            STEEMER_retrieved_path, STEEMER_expected_path, max_results, "STEEMER")
+        config = __read_config(kwargs["config_avaliacao"])
+        variants = config.sections()
+
+        def run_evaluation() -> None:
+            max_results = max(int(config[variant]["MAX"]) for variant in variants)
+            runs = [
+                evaluate.EvaluationRun(config[variant]["RESULTADOS"], config[variant]["ESPERADOS"], variant)
+                for variant in variants
+            ]
+
+            for run, color in zip(runs, COLORS):
+                evaluate.interpoloated_average_precision_11_point_graph(run, color)
+            plt.legend()
+            plt.savefig("./avalia/11pontos.jpeg")
+            plt.clf()
+
+            for run in runs:
+                evaluate.f1_score(run, max_results)
+
+            for run in runs:
+                evaluate.precision_at_n(run, 5)
+
+            for run in runs:
+                evaluate.precision_at_n(run, 10)
+
+            if len(runs) >= 2:
+                evaluate.r_precision_histogram(runs[:2], max_results)
+                plt.savefig("./avalia/histograma.jpeg")
+                plt.clf()
+
+            for run in runs:
+                evaluate.mean_average_precision(run, max_results)
+
+            for run in runs:
+                evaluate.mean_reciprocal_rank(run, 10, max_results)
+
+            for run in runs:
+                evaluate.discounted_cumulative_gain(run, max_results)
+
+            for run in runs:
+                evaluate.normalized_dicounted_comulative_gain(run, max_results)
+
+        stages.run(
+            "avaliacao", run_evaluation,
+            inputs=[kwargs["config_avaliacao"],
+                    *(path for variant in variants
+                      for path in (config[variant]["RESULTADOS"], config[variant]["ESPERADOS"])),
+                    *__sources("avaliacao")],
+            outputs=["./avalia"])
+
+    if kwargs["query"] or kwargs["serve"]:
+        config = __read_config(kwargs["config_busca"])
+        top_k = kwargs["top_k"] if kwargs["top_k"] is not None else 10
+        variants = {
+            variant: (config[variant]["MODELO"], __steemer(config[variant]))
+            for variant in config.sections()
+        }
+
+    if kwargs["query"]:
+        for variant, (model_path, steemer) in variants.items():
+            terms = utils.get_normalizer(stopwords=True, steemer=steemer).normalize(kwargs["query"])
+            results = search.search(terms, search.open_model(model_path), top_k, kwargs["max_score"])
+            print(f"{variant}: {' '.join(terms)}")
+            for rank, (doc, similarity) in enumerate(results, start=1):
+                print(f"{rank:4d} {doc:6d} {similarity:.6f}")
+
+    if kwargs["serve"]:
+        server.SearchServer(variants, top_k, kwargs["max_score"]).run(kwargs["host"], kwargs["port"])
 
     logging.info("End of program")
 
@@ -193,17 +340,73 @@ if __name__ == "__main__":
                         default="./config/busca.cfg", help="Sets the config file path for busca")
     parser.add_argument("--config-avaliacao", type=str,
                         default="./config/avaliacao.cfg", help="Sets the config file path for avaliacao")
-    parser.add_argument("--parse-queries", type=bool,
+    parser.add_argument("--parse-queries", action=argparse.BooleanOptionalAction,
                         default=True, help="Sets if it should parse queries")
-    parser.add_argument("--create-inverted-list",
-                        type=bool, default=False, help="Sets if it should create inverted list")
-    parser.add_argument("--run-indexer", type=bool,
+    parser.add_argument("--create-inverted-list", action=argparse.BooleanOptionalAction,
+                        default=False, help="Sets if it should create inverted list")
+    parser.add_argument("--run-indexer", action=argparse.BooleanOptionalAction,
                         default=True, help="Sets if it should run indexer")
-    parser.add_argument("--search", type=bool, default=True,
+    parser.add_argument("--search", action=argparse.BooleanOptionalAction, default=True,
                         help="Sets if it should performe a query")
-    parser.add_argument("--evaluate", type=bool, default=True,
+    parser.add_argument("--evaluate", action=argparse.BooleanOptionalAction, default=True,
                         help="Sets if it should performe a evaluation")
+    parser.add_argument("--state", type=str, default="./data/parsed/estagios.json",
+                        help="Sets the file where the hashes of each stage are recorded")
+    parser.add_argument("--force", nargs="*", choices=sorted(STAGE_SOURCES), default=None,
+                        help="Runs these stages even when they are up to date, or every stage when none is given")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Sets how many processes parse the documents files")
+    parser.add_argument("--memory-budget", type=int, default=None,
+                        help="Builds the model in sorted runs of at most this many megabytes, merged on disk, instead of holding the whole inverted list in memory")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Splits the documents of each model in this many shards, searched by one process each")
+    parser.add_argument("--partition", choices=shards.PARTITIONS, default="range",
+                        help="Sets how the documents are split in shards, by ranges of RECORDNUM or by a hash of it")
+    parser.add_argument("--prune", choices=pruning.METHODS, default=None,
+                        help="Prunes the postings with the smallest impact from the model once written, per term, per document or below a threshold")
+    parser.add_argument("--prune-level", type=float, default=0.5,
+                        help="Sets the fraction of the postings of each term or document kept by --prune term or --prune document, above 0 and at most 1")
+    parser.add_argument("--prune-threshold", type=float, default=None,
+                        help="Sets the smallest impact kept by --prune threshold, which needs it. The impact of a posting is its TF-IDF weight divided by the norm of its document, from 0 to 1")
+    parser.add_argument("--variant-workers", type=int, default=None,
+                        help="Sets how many variants (config sections) run in parallel processes, by default one per variant up to the number of CPUs")
+    parser.add_argument("--top-k", type=int, default=None,
+                        help="Sets how many documents are retrieved per query, overriding TOP_K in busca (0 retrieves all)")
+    parser.add_argument("--max-score", action="store_true",
+                        help="Skips documents that cannot enter the top k while searching")
+    parser.add_argument("--batch-search", action="store_true",
+                        help="Scores all queries together with sparse matrix products")
+    parser.add_argument("--search-workers", type=int, default=1,
+                        help="Sets how many processes score the queries of each variant, all of them sharing the memory-mapped model")
+    parser.add_argument("--run-format", choices=search.ResultWriter.FORMATS, default=None,
+                        help="Sets the format of the results file, overriding FORMATO in busca")
+    parser.add_argument("--add-documents", type=str, nargs="+", default=None,
+                        help="Adds the documents of these XML files to the incremental index (INDICE in index), replacing documents with the same RECORDNUM")
+    parser.add_argument("--delete-documents", type=int, nargs="+", default=None,
+                        help="Deletes these RECORDNUMs from the incremental index")
+    parser.add_argument("--merge-segments", action="store_true",
+                        help="Merges the segments of the incremental index, dropping deleted documents")
     parser.add_argument("-q", "--query", type=str,
-                        default="", help="Text for a single query")
+                        default="", help="Text for a single query, whose top results are printed for each variant")
+    parser.add_argument("--serve", action="store_true",
+                        help="Serves queries over HTTP with the models kept in memory")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Sets the address the search server listens on")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Sets the port the search server listens on")
+    parser.add_argument("--profile", type=str, nargs="?", const="./data/parsed/perfil.prof", default=None,
+                        help="Profiles the run with cProfile and tracemalloc, saving the statistics to this file. Only the main process is profiled, so use it with --workers 1 --variant-workers 1 to see every stage")
+    parser.add_argument("--summary", type=str, default="./data/parsed/resumo.json",
+                        help="Sets the JSON file where the time, counters and profile of each stage are saved")
     args = vars(parser.parse_args())
-    main(**args)
+    if args["prune"] == "threshold" and args["prune_threshold"] is None:
+        parser.error("--prune threshold needs --prune-threshold")
+    if not 0 < args["prune_level"] <= 1:
+        parser.error("--prune-level must be above 0 and at most 1")
+    profile, summary_path = args.pop("profile"), args.pop("summary")
+    if profile is None:
+        main(**args)
+    else:
+        with utils.instrumentation.profile(profile):
+            main(**args)
+    utils.instrumentation.write_summary(summary_path)
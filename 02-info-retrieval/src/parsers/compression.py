@@ -0,0 +1,130 @@
+import logging
+from typing import Tuple
+
+import numpy as np
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+BLOCK_SIZE = 128
+BYTE_DTYPE = np.uint8
+
+# The largest value each number of bytes can hold, 7 bits per byte.
+__LIMITS = np.array([1 << (7 * n) for n in range(1, 10)], dtype=np.uint64)
+
+
+def varbyte_lengths(values: np.ndarray) -> np.ndarray:
+    """
+    How many bytes the variable-byte code of each value takes.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    maximum = values.max() if len(values) else 0
+    for limit in __LIMITS[__LIMITS <= maximum]:
+        lengths += values >= limit
+    return lengths
+
+
+def encode_varbyte(values: np.ndarray) -> np.ndarray:
+    """
+    Encode non-negative integers with a variable-byte code: 7 bits per byte, least
+    significant first, with the high bit set on every byte but the last of each number.
+
+    Example:
+    >>> encode_varbyte([5, 300]).tolist()
+    [5, 172, 2]
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = varbyte_lengths(values)
+    numbers = np.repeat(np.arange(len(values)), lengths)
+    positions = np.arange(len(numbers)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    data = (values[numbers] >> (7 * positions).astype(np.uint64)) & np.uint64(0x7F)
+    data[positions < lengths[numbers] - 1] |= np.uint64(0x80)
+    return data.astype(BYTE_DTYPE)
+
+
+def decode_varbyte(data: np.ndarray) -> np.ndarray:
+    """
+    Decode a sequence of numbers written by `encode_varbyte`, with no Python loop over them.
+    """
+    data = np.asarray(data, dtype=BYTE_DTYPE)
+    ends = data < 0x80
+    if ends.all():
+        # Every number fits in a single byte, which is the common case for the frequencies.
+        return data.astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(ends[:-1]) + 1))
+    numbers = np.cumsum(ends) - ends
+    shifts = 7 * (np.arange(len(data)) - starts[numbers])
+    return np.add.reduceat((data & 0x7F).astype(np.int64) << shifts, starts)
+
+
+def encode_postings(doc_ids: np.ndarray, frequencies: np.ndarray, counts: np.ndarray, block_size: int = BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Compress the postings of one or more terms, each sorted by document id, in blocks of
+    `block_size`. The postings of the terms are concatenated, `counts[t]` of them for term t.
+
+    The document ids are stored as the gaps between consecutive ids of a term (the first
+    one as is) and each block holds the variable-byte codes of its gaps followed by the ones
+    of its term frequencies. Each block records its byte length, so a block can be decoded
+    without the ones before it, and its last document id, the skip pointer used to find the
+    blocks that may hold a given document.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray, np.ndarray]: the encoded blocks, the byte length of each
+      block and the last document id of each block
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    term_starts = (np.cumsum(counts) - counts)[counts > 0]
+    block_offsets, sizes = block_sizes(counts, block_size)
+    positions = np.arange(len(doc_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+    blocks = np.repeat(block_offsets[:-1], counts) + positions // block_size
+
+    gaps = np.diff(doc_ids, prepend=0)
+    gaps[term_starts] = doc_ids[term_starts]
+    # A stable sort by block keeps the gaps of each block before its frequencies.
+    values = np.concatenate((gaps, np.asarray(frequencies, dtype=np.int64)))
+    values = values[np.argsort(np.concatenate((blocks, blocks)), kind="stable")]
+    lengths = varbyte_lengths(values)
+    block_ends = np.cumsum(sizes)
+    return (
+        encode_varbyte(values),
+        np.add.reduceat(lengths, 2 * (block_ends - sizes)) if len(doc_ids) else lengths,
+        doc_ids[block_ends - 1],
+    )
+
+
+def decode_blocks(data: np.ndarray, sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode consecutive blocks written by `encode_postings`, holding `sizes` postings each.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: the gaps and the frequencies of the postings
+    """
+    values = decode_varbyte(data)
+    if len(sizes) == 1:
+        return values[:sizes[0]], values[sizes[0]:]
+    is_gap = np.repeat(np.tile([True, False], len(sizes)), np.repeat(sizes, 2))
+    return values[is_gap], values[~is_gap]
+
+
+def block_sizes(counts: np.ndarray, block_size: int = BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Split lists of `counts` postings in blocks.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: the index of the first block of each list, plus the
+      total number of blocks, and the number of postings of every block
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    n_blocks = -(-counts // block_size)
+    block_offsets = np.concatenate(([0], np.cumsum(n_blocks)))
+    positions = np.arange(block_offsets[-1]) - np.repeat(block_offsets[:-1], n_blocks)
+    return block_offsets, np.minimum(block_size, np.repeat(counts, n_blocks) - positions * block_size)
+
+
+def byte_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    The indexes of every byte of the ranges [starts[i], ends[i]), in order.
+    """
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
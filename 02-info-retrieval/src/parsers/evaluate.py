@@ -1,85 +1,156 @@
 import logging
 import csv
+import json
 import statistics
-import math
 from collections import defaultdict
-from typing import Dict, List
+from typing import Dict, List, Set, Tuple
 
 import matplotlib.pyplot as plt
-from nltk.metrics import precision, recall, f_measure
+import numpy as np
 
 import utils
+import utils.instrumentation
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
-def __read_retrieved_documents(path: str) -> defaultdict:
-    results = defaultdict(list)
-    with open(path, "r", encoding="utf-8") as csv_file:
-        rows = csv.DictReader(csv_file, delimiter=";")
-        for row in rows:
-            result = eval(row["Result"])
-            results[int(row["QueryNumber"])].append({
-                "Document": int(result[0]),
-                "Rank": int(result[1]),
-                "Similarity": float(result[2])
-            })
-    return results
-
-
-def __read_expected_documents(path: str) -> defaultdict:
-    expected = defaultdict(list)
-    with open(path, "r", encoding="utf-8") as csv_file:
-        rows = csv.DictReader(csv_file, delimiter=";")
-        for row in rows:
-            expected[int(row["QueryNumber"])].append({
-                "Document": int(row["DocNumber"]),
-                "Votes": int(row["DocVotes"])
-            })
-    return expected
-
-
-def interpoloated_average_precision_11_point_graph(retrieved_path: str, expected_path: str, label: str, color: str) -> None:
-    logging.info(
-        "EVALUATION - Plotting 11-Point Interpolated Average Precision")
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
-    precisions = defaultdict(list)
-    recalls = defaultdict(list)
-    interpolations = []
-
-    for query, documents in expected.items():
-        reference = set(map(lambda x: x["Document"], documents))
-        for i in range(len(retrieved[query])):
-            test = set(map(lambda x: x["Document"], retrieved[query][:i+1]))
-            precisions[query].append(
-                precision(reference, test)
-            )
-            recalls[query].append(
-                recall(reference, test)
-            )
+class EvaluationRun:
+    """
+    A results file and its expected documents, loaded once into compact per-query arrays
+    that every metric of this module reads from.
+
+    Args:
+    - retrieved_path (str): the path to the results file written by the search, in the "csv" or "trec" format
+    - expected_path (str): the path to the expected documents CSV file written by the query processor
+    - label (str): the name of the run, used in logs, plots and output file names
+
+    Attributes:
+    - queries (List[int]): the queries with expected documents, in the order of the expected file
+    - documents (Dict[int, np.ndarray]): the retrieved document numbers of each query, by rank
+    - ranks (Dict[int, np.ndarray]): the rank of each retrieved document, starting at 0
+    - similarities (Dict[int, np.ndarray]): the similarity of each retrieved document
+    - expected (Dict[int, np.ndarray]): the expected document numbers of each query
+    - votes (Dict[int, np.ndarray]): the votes of each expected document
+    - relevance (Dict[int, np.ndarray]): the votes of each retrieved document, 0 when it is not expected
+    - hits (Dict[int, np.ndarray]): whether each retrieved document is expected
+
+    Example:
+    >>> run = EvaluationRun('./data/parsed/resultados.csv', './data/parsed/esperados.csv', 'NOSTEEMER')
+    >>> mean_average_precision(run, 10)
+    """
+
+    @utils.instrumentation.timed
+    def __init__(self, retrieved_path: str, expected_path: str, label: str):
+        logging.info("EVALUATION - Loading %s's run %s", label, retrieved_path)
+        self.label = label
+        self.documents, self.ranks, self.similarities = self.__read_retrieved_documents(retrieved_path)
+        self.queries, self.expected, self.votes = self.__read_expected_documents(expected_path)
+        self.relevance = {}
+        self.hits = {}
+        for query in self.queries:
+            votes = dict(zip(self.expected[query].tolist(), self.votes[query].tolist()))
+            self.relevance[query] = np.array(
+                [votes.get(doc, 0) for doc in self.retrieved(query).tolist()], dtype=np.int32)
+            self.hits[query] = np.isin(self.retrieved(query), self.expected[query])
+
+    @staticmethod
+    def __read_retrieved_documents(path: str) -> Tuple[Dict[int, np.ndarray], Dict[int, np.ndarray], Dict[int, np.ndarray]]:
+        documents = defaultdict(list)
+        ranks = defaultdict(list)
+        similarities = defaultdict(list)
+        with open(path, "r", encoding="utf-8") as csv_file:
+            if csv_file.readline().startswith("QueryNumber"):
+                rows = csv.reader(csv_file, delimiter=";")
+                for query, result in rows:
+                    document, rank, similarity = json.loads(result)
+                    documents[int(query)].append(document)
+                    ranks[int(query)].append(rank)
+                    similarities[int(query)].append(similarity)
+            else:
+                csv_file.seek(0)
+                for row in csv_file:
+                    query, _, document, rank, similarity, _ = row.split()
+                    documents[int(query)].append(int(document))
+                    ranks[int(query)].append(int(rank) - 1)
+                    similarities[int(query)].append(float(similarity))
+        return (
+            {query: np.array(values, dtype=np.int32) for query, values in documents.items()},
+            {query: np.array(values, dtype=np.int32) for query, values in ranks.items()},
+            {query: np.array(values, dtype=np.float64) for query, values in similarities.items()}
+        )
 
-    queries = set(expected.keys())
-    eleven_points = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]
-
-    for query in queries:
-        inter = []
-        for i, _ in enumerate(eleven_points):
-            pr = zip(precisions[query], recalls[query])
-            ri = filter(lambda x: x[1] >= eleven_points[i], pr)
-            interpolation = max(list(map(lambda x: x[0], ri)), default=0)
-            inter.append(interpolation)
-        interpolations.append(inter)
-
-    interpolation_mean = []
-    for i, _ in enumerate(eleven_points):
-        interpolation_mean.append(
-            statistics.mean(
-                list(map(lambda x: x[i], interpolations))
-            )
+    @staticmethod
+    def __read_expected_documents(path: str) -> Tuple[List[int], Dict[int, np.ndarray], Dict[int, np.ndarray]]:
+        expected = defaultdict(list)
+        votes = defaultdict(list)
+        with open(path, "r", encoding="utf-8") as csv_file:
+            rows = csv.DictReader(csv_file, delimiter=";")
+            for row in rows:
+                expected[int(row["QueryNumber"])].append(int(row["DocNumber"]))
+                votes[int(row["QueryNumber"])].append(int(row["DocVotes"]))
+        return (
+            list(expected.keys()),
+            {query: np.array(values, dtype=np.int32) for query, values in expected.items()},
+            {query: np.array(values, dtype=np.int32) for query, values in votes.items()}
         )
 
-    plt.plot(eleven_points, interpolation_mean, "--", color=color, label=label)
+    def retrieved(self, query: int) -> np.ndarray:
+        return self.documents.get(query, np.zeros(0, dtype=np.int32))
+
+    def reference(self, query: int) -> Set[int]:
+        return set(self.expected[query].tolist())
+
+
+def __precision_at(hits: np.ndarray, n: int) -> float:
+    """
+    The precision of the first `n` retrieved documents, 0 when nothing was retrieved.
+    """
+    n = min(n, len(hits))
+    if n == 0:
+        return 0.0
+    return float(np.count_nonzero(hits[:n]) / n)
+
+
+def __recall_at(hits: np.ndarray, n: int, n_expected: int) -> float:
+    return float(np.count_nonzero(hits[:n]) / n_expected)
+
+
+def __f_measure(p: float, r: float) -> float:
+    if p == 0 or r == 0:
+        return 0.0
+    return 2 * p * r / (p + r)
+
+
+def __discounted_gains(gains: np.ndarray) -> np.ndarray:
+    """
+    Discount the gain at each rank i by log2(i), except the first one, as in the Modern
+    Information Retrieval DCG.
+    """
+    return gains / np.log2(np.maximum(np.arange(1, len(gains) + 1), 2))
+
+
+@utils.instrumentation.timed
+def interpoloated_average_precision_11_point_graph(run: EvaluationRun, color: str) -> None:
+    logging.info(
+        "EVALUATION - Plotting 11-Point Interpolated Average Precision")
+    eleven_points = np.array([0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1])
+    interpolations = np.zeros((len(run.queries), len(eleven_points)))
+
+    for row, query in enumerate(run.queries):
+        hits = run.hits[query]
+        if not len(hits):
+            continue
+        correct = np.cumsum(hits)
+        precisions = correct / np.arange(1, len(hits) + 1)
+        recalls = correct / len(np.unique(run.expected[query]))
+        best_precisions = np.maximum.accumulate(precisions[::-1])[::-1]
+        positions = np.searchsorted(recalls, eleven_points, side="left")
+        reached = positions < len(hits)
+        interpolations[row, reached] = best_precisions[positions[reached]]
+
+    interpolation_mean = interpolations.mean(axis=0)
+
+    plt.plot(eleven_points, interpolation_mean, "--", color=color, label=run.label)
     plt.plot(eleven_points, interpolation_mean, ".", color=color)
     plt.xlabel("Precision")
     plt.ylabel("Recall")
@@ -88,20 +159,20 @@ def interpoloated_average_precision_11_point_graph(retrieved_path: str, expected
     logging.info("EVALUATION - Plotted")
 
 
-def f1_score(retrieved_path: str, expected_path: str, label: str, max_results: int = 10) -> None:
+@utils.instrumentation.timed
+def f1_score(run: EvaluationRun, max_results: int = 10) -> None:
+    label = run.label
     logging.info(
         "EVALUATION - Calculating %s's F1-Score", label
     )
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
     scores = []
-    for query, documents in expected.items():
-        reference = set(map(lambda x: x["Document"], documents))
-        lim = min(len(documents), max_results)
-        test = set(map(lambda x: x["Document"], retrieved[query][:lim]))
-        scores.append(
-            f_measure(reference, test)
-        )
+    for query in run.queries:
+        hits = run.hits[query]
+        lim = min(len(run.expected[query]), max_results)
+        scores.append(__f_measure(
+            __precision_at(hits, lim),
+            __recall_at(hits, lim, len(np.unique(run.expected[query])))
+        ))
 
     mean_f1 = statistics.mean(scores)
     utils.write_to_csv(
@@ -111,18 +182,16 @@ def f1_score(retrieved_path: str, expected_path: str, label: str, max_results: i
     )
 
 
-def precision_at_n(retrieved_path: str, expected_path: str, n: int, label: str) -> Dict[str, List[int]]:
+@utils.instrumentation.timed
+def precision_at_n(run: EvaluationRun, n: int) -> Dict[int, float]:
+    label = run.label
     logging.info(
         "EVALUATION - Calculating %s's P@%d", label, n
     )
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
     precisions = {}
-    for query, documents in expected.items():
-        reference = set(map(lambda x: x["Document"], documents))
-        lim = min(len(documents), n)
-        test = set(map(lambda x: x["Document"], retrieved[query][:lim]))
-        precisions[query] = precision(reference, test)
+    for query in run.queries:
+        lim = min(len(run.expected[query]), n)
+        precisions[query] = __precision_at(run.hits[query], lim)
 
     utils.write_to_csv(f"./avalia/p@{n}_{label}.csv", ["label", "query", "precision"], [
                        (label, query, p)for query, p in precisions.items()])
@@ -133,19 +202,15 @@ def precision_at_n(retrieved_path: str, expected_path: str, n: int, label: str)
     return precisions
 
 
-def r_precision(retrieved_path: str, expected_path: str, r: int, label: str) -> Dict[str, List[int]]:
+def r_precision(run: EvaluationRun, r: int) -> Dict[int, float]:
+    label = run.label
     logging.info(
         "EVALUATION - Calculating %s's R-precision", label
     )
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
     r_precisions = {}
-    for query, documents in expected.items():
-        reference = set(map(lambda x: x["Document"], documents))
-        lim = min(len(documents), r)
-        test = set(map(lambda x: x["Document"], retrieved[query][:lim]))
-        correct = list(filter(lambda x: x in reference, test))
-        r_precisions[query] = len(correct)/len(test)
+    for query in run.queries:
+        lim = min(len(run.expected[query]), r)
+        r_precisions[query] = __precision_at(run.hits[query], lim)
 
     for query, r in r_precisions.items():
         logging.info(
@@ -154,15 +219,14 @@ def r_precision(retrieved_path: str, expected_path: str, r: int, label: str) ->
     return r_precisions
 
 
-def r_precision_histogram(retrieved_paths: List[str], expected_paths: List[str], r: int, labels: List[str]) -> None:
+@utils.instrumentation.timed
+def r_precision_histogram(runs: List[EvaluationRun], r: int) -> None:
     logging.info(
         "EVALUATION - R-Precision Histogram"
     )
 
-    r_precisions_01 = r_precision(
-        retrieved_paths[0], expected_paths[0], r, labels[0])
-    r_precisions_02 = r_precision(
-        retrieved_paths[1], expected_paths[1], r, labels[1])
+    r_precisions_01 = r_precision(runs[0], r)
+    r_precisions_02 = r_precision(runs[1], r)
 
     r_precision_total = {}
     for query in r_precisions_01.keys():
@@ -173,7 +237,7 @@ def r_precision_histogram(retrieved_paths: List[str], expected_paths: List[str],
             r_precision_total.values(),
             width=0.75,
             color="blue",
-            label=labels[0]
+            label=runs[0].label
             )
 
     negative = dict(filter(lambda x: x[1] < 0, r_precision_total.items()))
@@ -181,7 +245,7 @@ def r_precision_histogram(retrieved_paths: List[str], expected_paths: List[str],
             negative.values(),
             width=0.75,
             color="red",
-            label=labels[1]
+            label=runs[1].label
             )
 
     plt.plot(
@@ -193,29 +257,25 @@ def r_precision_histogram(retrieved_paths: List[str], expected_paths: List[str],
     logging.info("EVALUATION - Plotted")
 
 
-def mean_average_precision(retrieved_path: str, expected_path: str, max_n: int, label: str) -> float:
+@utils.instrumentation.timed
+def mean_average_precision(run: EvaluationRun, max_n: int) -> float:
+    """
+    The mean over the queries of the average precision of the first `max_n` retrieved
+    documents: the sum of the precision at the rank of every expected document retrieved,
+    divided by the number of expected documents that fit in `max_n` ranks.
+    """
+    label = run.label
     logging.info(
         "EVALUATION - Calculating %s's MAP", label
     )
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
-    precisions = defaultdict(list)
-    for n in range(max_n):
-        last_precision = 0.0
-        for query, documents in expected.items():
-            reference = set(map(lambda x: x["Document"], documents))
-            lim = min(len(documents), n+1)
-            test = set(map(lambda x: x["Document"], retrieved[query][:lim]))
-            p = precision(reference, test)
-            if p > last_precision:
-                precisions[query].append(p)
-            last_precision = p
-
-    mean_precisions = []
-    for p in precisions.values():
-        mean_precisions.append(statistics.mean(p))
-
-    m = statistics.mean(mean_precisions)
+    average_precisions = []
+    for query in run.queries:
+        hits = run.hits[query][:max_n]
+        precisions = np.cumsum(hits) / np.arange(1, len(hits) + 1)
+        lim = min(len(run.expected[query]), max_n)
+        average_precisions.append(float(precisions[hits].sum() / lim))
+
+    m = statistics.mean(average_precisions)
     utils.write_to_csv(
         f"./avalia/map_{label}.csv", ["label", "map"], [(label, m)])
     logging.info(
@@ -224,25 +284,25 @@ def mean_average_precision(retrieved_path: str, expected_path: str, max_n: int,
     return m
 
 
-def mean_reciprocal_rank(retrieved_path: str, expected_path: str, max_k: int, max_n: int, label: str) -> float:
+@utils.instrumentation.timed
+def mean_reciprocal_rank(run: EvaluationRun, max_k: int, max_n: int) -> float:
+    """
+    The mean over the queries of the inverse of the rank of the first expected document,
+    looking at the first min(expected documents, `max_n`, `max_k` + 1) ranks. A query
+    without an expected document in those ranks counts as 0.
+    """
+    label = run.label
     logging.info(
         "EVALUATION - Calculating %s's MRR", label
     )
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
     reciprocal_ranks = []
-    for query, expected_documents in expected.items():
-        reference = set(map(lambda x: x["Document"], expected_documents))
-        lim = min(
-            len(reference), max_n
-        )
-        for k, retrieved_document in enumerate(retrieved[query][:lim]):
-            if k > max_k:
-                reciprocal_ranks.append(0)
-                break
-            if retrieved_document["Document"] in reference:
-                reciprocal_ranks.append(1/(k + 1))
-                break
+    for query in run.queries:
+        lim = min(len(run.expected[query]), max_n, max_k + 1)
+        hits = run.hits[query][:lim]
+        if hits.any():
+            reciprocal_ranks.append(1 / (int(np.argmax(hits)) + 1))
+        else:
+            reciprocal_ranks.append(0)
 
     mrr = statistics.mean(reciprocal_ranks)
     utils.write_to_csv(
@@ -253,43 +313,20 @@ def mean_reciprocal_rank(retrieved_path: str, expected_path: str, max_k: int, ma
     return mrr
 
 
-def __calculate_discount(rank: int, i: int, dcg_1: int = 0) -> float:
-    if i == 1:
-        return rank
-    return rank/math.log(i, 2) + dcg_1
-
-
-def discounted_cumulative_gain(retrieved_path: str, expected_path: str, max_n: int, label: str) -> float:
+@utils.instrumentation.timed
+def discounted_cumulative_gain(run: EvaluationRun, max_n: int) -> Dict[int, float]:
+    """
+    The mean, over the first `max_n` ranks, of the DCG of each query at every rank.
+    """
+    label = run.label
     logging.info(
         "EVALUATION - Calculating %s's DCG", label
     )
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
-    dcgs = defaultdict(list)
-    for query, expected_documents in expected.items():
-        reference = set(map(lambda x: x["Document"], expected_documents))
-        # lim = min(
-        #     len(expected_documents), max_n
-        # )
-        lim = max_n
-        dcg_1 = 0
-        for i, document in enumerate(retrieved[query][:lim]):
-            doc_number = document["Document"]
-            if doc_number in reference:
-                a = filter(lambda x: x["Document"] ==
-                           doc_number, expected_documents)
-                b = list(map(lambda x: x["Votes"], a))[0]
-                dcgs[query].append(__calculate_discount(b, i + 1, dcg_1))
-                if i == 0:
-                    dcg_1 = b
-            else:
-                dcgs[query].append(__calculate_discount(0, i + 1, dcg_1))
-                if i == 0:
-                    dcg_1 = 0
-
     mean_dcg = {}
-    for query, dcg in dcgs.items():
-        mean_dcg[query] = statistics.mean(dcg)
+    for query in run.queries:
+        gains = run.relevance[query][:max_n]
+        if len(gains):
+            mean_dcg[query] = float(np.cumsum(__discounted_gains(gains)).mean())
 
     utils.write_to_csv(
         f"./avalia/dcg-mean_{label}.csv", ["label", "query", "dcg"], [(label, query, dcg) for query, dcg in mean_dcg.items()])
@@ -302,34 +339,21 @@ def discounted_cumulative_gain(retrieved_path: str, expected_path: str, max_n: i
     return mean_dcg
 
 
-def normalized_dicounted_comulative_gain(retrieved_path: str, expected_path: str, max_n: int, label: str) -> Dict[int, float]:
+@utils.instrumentation.timed
+def normalized_dicounted_comulative_gain(run: EvaluationRun, max_n: int) -> Dict[int, float]:
+    label = run.label
     logging.info(
         "EVALUATION - Calculating %s's DCG", label
     )
-    retrieved = __read_retrieved_documents(retrieved_path)
-    expected = __read_expected_documents(expected_path)
     ndcgs = defaultdict(float)
-    for query, expected_documents in expected.items():
-        reference = set(map(lambda x: x["Document"], expected_documents))
+    for query in run.queries:
         lim = min(
-            len(expected_documents), max_n
+            len(run.expected[query]), max_n
         )
-        sorted_expected_documents = sorted(expected_documents,
-                                           key=lambda x: x["Votes"], reverse=True)[:lim]
-        idcg = 0
-        for i, document in enumerate(sorted_expected_documents):
-            idcg += __calculate_discount(document["Votes"], i + 1)
-        dcg = 0
-        for i, document in enumerate(retrieved[query][:lim]):
-            doc_number = document["Document"]
-            if doc_number in reference:
-                a = filter(lambda x: x["Document"] ==
-                           doc_number, expected_documents)
-                b = list(map(lambda x: x["Votes"], a))[0]
-                dcg += __calculate_discount(b, i + 1)
-            else:
-                dcg += __calculate_discount(0, i + 1)
-        ndcgs[query] = dcg/idcg
+        ideal_gains = np.sort(run.votes[query])[::-1][:lim]
+        idcg = __discounted_gains(ideal_gains).sum()
+        dcg = __discounted_gains(run.relevance[query][:lim]).sum()
+        ndcgs[query] = float(dcg/idcg)
 
     utils.write_to_csv(
         f"./avalia/ndcg_{label}.csv", ["label", "query", "ndcg"], [(label, query, ndcg) for query, ndcg in ndcgs.items()])
@@ -1,38 +1,133 @@
-import json
+import csv
 import logging
 import math
-from collections import defaultdict
-from typing import List
+import os
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
 
 import parsers.inverted_list
+import parsers.model
+import parsers.pruning
+import parsers.shards
+import parsers.spimi
+import utils.instrumentation
 
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
-def write_model(input_paths: List[str], output_path_inverted_list: str, output_path_model: str, steemer: str = False) -> None:
+def __model_writer(output_path_model: str, documents: List[int], max_frequencies: List[int], shards: int, partition: str) -> Union[parsers.model.ModelWriter, parsers.shards.ShardWriter]:
+    """
+    The writer of a single model, or of a model split in `shards` shards when there is more
+    than one (see `parsers.shards`).
+    """
+    if shards > 1:
+        return parsers.shards.ShardWriter(output_path_model, documents, max_frequencies, shards, partition)
+    return parsers.model.ModelWriter(output_path_model, documents, max_frequencies)
+
+
+def __write_model_from_runs(input_paths: List[str], output_path_inverted_list: str, output_path_model: str, steemer: bool, workers: int, memory_budget: int, shards: int, partition: str) -> None:
+    """
+    Build the model with a bounded amount of memory (see `parsers.spimi`): the documents are
+    indexed into sorted run files, and the runs are merged one term at a time straight into
+    the inverted list CSV file and the model writer.
+    """
+    runs_path = os.path.normpath(output_path_model) + ".runs"
+    run_paths, max_freq_in_document = parsers.spimi.write_runs(
+        input_paths, runs_path, steemer=steemer, memory_budget=memory_budget, workers=workers)
+    documents = sorted(max_freq_in_document.keys())
+    doc_numbers = np.asarray(documents)
+    total_documents = len(documents)
+
+    logging.info("INDEXER - Merging %d runs into the TF-IDF model %s", len(run_paths), output_path_model)
+    with open(output_path_inverted_list, "w", encoding="utf-8") as file, \
+            __model_writer(output_path_model, documents, [max_freq_in_document[doc] for doc in documents],
+                           shards, partition) as writer:
+        inverted_list_writer = csv.writer(file, delimiter=";", quotechar="\"")
+        n_terms = 0
+        for term, postings in parsers.spimi.merge_runs(run_paths):
+            doc_num, frequencies = zip(*postings)
+            inverted_list_writer.writerow((term, [doc for doc, frequency in postings for _ in range(frequency)]))
+            idf = math.log(total_documents / len(doc_num))
+            writer.add(term, idf, np.searchsorted(doc_numbers, doc_num), frequencies)
+            utils.instrumentation.count("postings indexed", len(doc_num))
+            n_terms += 1
+    utils.instrumentation.count("terms indexed", n_terms)
+    parsers.spimi.remove_runs(runs_path)
+
+
+@utils.instrumentation.timed
+def write_model(input_paths: List[str], output_path_inverted_list: str, output_path_model: str, steemer: str = False, output_path_json: str = None, workers: int = 1, postings: Tuple[Dict[str, Dict[int, int]], Dict[int, int]] = None, memory_budget: int = None, shards: int = 1, partition: str = "range", prune: str = None, prune_level: float = 0.5, prune_threshold: float = None) -> None:
     """
     Calculates the weight of each term for each document using the TF-IDF formula,
-    and writes a dictionary of document-term weights to a JSON file.
+    and writes the model as a binary directory (see `parsers.model`).
+
+    The model is stored term-major, so the search only needs to visit the postings of the
+    query terms, and the euclidean norm of every document vector is computed once here
+    instead of once per query.
 
     Args:
     - input_paths (List[str]): A list of paths to input XML files containing documents to process.
     - output_path_inverted_list (str): The path to write the output CSV file containing the inverted index.
-    - output_path_model (str): The path to write the output JSON file containing the document-term weights.
+    - output_path_model (str): The path to write the model directory.
+    - output_path_json (str): If given, the model is also exported as a JSON file, for debugging.
+    - workers (int): The number of processes used to parse the input files.
+    - postings (Tuple[Dict[str, Dict[int, int]], Dict[int, int]]): an inverted list that was already built
+      (see `parsers.inverted_list.parse`), so the input files are not read again.
+    - memory_budget (int): if given, and no `postings` are, the inverted list is never held in memory as a
+      whole: it is built in sorted runs of at most this many megabytes, which are merged on disk
+      (see `parsers.spimi`). The terms of the inverted list CSV file are then in alphabetical order.
+    - shards (int): if more than 1, the documents are split in this many shards, each one a model
+      of its own that can be searched by a different process or node (see `parsers.shards`).
+    - partition (str): how the documents are split in shards, "range" (of record numbers) or "hash".
+    - prune (str): if given, the model (or each of its shards) is pruned once written, with the "term",
+      "document" or "threshold" method (see `parsers.pruning`).
+    - prune_level (float): the fraction of the postings of each term or document kept by the "term" and
+      "document" pruning, above 0 and at most 1.
+    - prune_threshold (float): the smallest impact kept by the "threshold" pruning, which must be given
+      with it. The impact of a posting is its TF-IDF weight divided by the norm of its document, from 0 to 1
+      (see `parsers.pruning.impacts`).
 
     Returns:
     - None
+
+    Saves:
+    - A model directory with the term dictionary, the compressed postings of each term
+      (document ids and term frequencies, from which the TF-IDF weights are computed with the
+      largest frequency of each document), the IDF of each term, the norm of each document and, for each term,
+      the largest weight/norm ratio in its postings, which bounds how much the term can add
+      to the similarity of any document.
     """
-    inverted_list, max_freq_in_document = parsers.inverted_list.parse(
-        input_paths, output_path_inverted_list, steemer=steemer)
-    docs = defaultdict(lambda: defaultdict(float))
-    total_documents = len(list(max_freq_in_document.values()))
-    for term, doc_numbers in inverted_list.items():
-        doc_num = set(doc_numbers)
-        for doc in doc_num:
-            docs[doc][term] = (doc_numbers.count(doc) / max_freq_in_document[doc]) * \
-                math.log(total_documents / len(doc_num))
-
-    logging.info("INDEXER - Saving TF-IDF model file as %s", output_path_model)
-    with open(output_path_model, "w", encoding="utf-8") as file:
-        json.dump(docs, file, sort_keys=True, indent=2)
+    if prune == "threshold" and prune_threshold is None:
+        raise ValueError("The threshold pruning needs a prune_threshold")
+    if memory_budget is not None and postings is None:
+        __write_model_from_runs(input_paths, output_path_inverted_list, output_path_model,
+                                steemer, workers, memory_budget, shards, partition)
+    else:
+        inverted_list, max_freq_in_document = parsers.inverted_list.parse(
+            input_paths, output_path_inverted_list, steemer=steemer, workers=workers, postings=postings)
+        documents = sorted(max_freq_in_document.keys())
+        doc_ids = {doc: doc_id for doc_id, doc in enumerate(documents)}
+        total_documents = len(documents)
+
+        logging.info("INDEXER - Saving TF-IDF model as %s", output_path_model)
+        with __model_writer(output_path_model, documents, [max_freq_in_document[doc] for doc in documents],
+                            shards, partition) as writer:
+            for term in sorted(inverted_list.keys()):
+                frequencies = inverted_list[term]
+                doc_num = sorted(frequencies)
+                idf = math.log(total_documents / len(doc_num))
+                writer.add(term, idf, [doc_ids[doc] for doc in doc_num],
+                           [frequencies[doc] for doc in doc_num])
+                utils.instrumentation.count("postings indexed", len(doc_num))
+        utils.instrumentation.count("terms indexed", len(inverted_list))
+
+    if prune:
+        for path in parsers.shards.shard_paths(output_path_model) if shards > 1 else [output_path_model]:
+            parsers.pruning.prune(path, path, prune, prune_threshold if prune == "threshold" else prune_level)
+
+    if output_path_json:
+        parsers.model.write_json(
+            output_path_json, parsers.shards.load(output_path_model) if shards > 1
+            else parsers.model.load(output_path_model))
@@ -1,111 +1,200 @@
+import heapq
 import logging
-import xml.dom.minidom
-from collections import defaultdict
-from typing import Dict, List, Tuple, DefaultDict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple, DefaultDict
 
+import parsers.reader
 import utils
+import utils.instrumentation
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
-def __read_raw_documents_file(input_path: str, inverted_list: Dict[str, List[int]], max_freq_in_document: Dict[int, float], steemer: bool = False) -> Tuple[DefaultDict[str, List[int]], DefaultDict[int, float]]:
+def __read_raw_documents_file(input_path: str, inverted_list: Dict[str, Dict[int, int]], max_freq_in_document: Dict[int, int], steemer: bool = False) -> Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]:
     """
     Read an XML file and extract terms from the abstracts or extracts.
 
+    The records are streamed one at a time (see `parsers.reader`), and the terms of each
+    document are counted once, so every term adds a single (record number, frequency)
+    entry to its postings.
+
     Args:
     - input_path (str): the path to the XML file to read
-    - inverted_list (Dict[str, List[int]]): the dictionary of terms and their record numbers
-    - max_freq_in_document (Dict[int, float]): the dictionary of record numbers and their maximum frequency of occurrence
+    - inverted_list (Dict[str, Dict[int, int]]): the dictionary of terms and the frequency of the term in each record
+    - max_freq_in_document (Dict[int, int]): the dictionary of record numbers and their maximum frequency of occurrence
 
     Returns:
-    - Tuple[Dict[str, List[int]], Dict[int, float]]: a tuple of the inverted list and the maximum frequency in each document
+    - Tuple[Dict[str, Dict[int, int]], Dict[int, int]]: a tuple of the inverted list and the maximum frequency in each document
     """
     logging.info(
         "INVERTED LIST PARSER - Reading file %s", input_path
     )
-    with xml.dom.minidom.parse(input_path) as doc:
-        logging.info("INVERTED LIST PARSER - Parsing file %s", input_path)
-        for record in doc.getElementsByTagName("RECORD"):
-            record_num = record.getElementsByTagName(
-                "RECORDNUM"
-            )[0].firstChild.nodeValue
-            record_num = int(record_num.strip())
-
-            abstract = record.getElementsByTagName(
-                "ABSTRACT"
+    normalizer = utils.get_normalizer(stopwords=True, steemer=steemer)
+    n_documents = n_tokens = 0
+    for record in parsers.reader.read_records(input_path):
+        terms = Counter(normalizer.normalize(record.text))
+        if not terms:
+            continue
+        n_documents += 1
+        n_tokens += sum(terms.values())
+        max_freq_in_document[record.record_num] = max(terms.values())
+        for term, frequency in terms.items():
+            inverted_list[term][record.record_num] = frequency
+            logging.debug(
+                "INVERTED LIST - LIST: Term: %s; Document: %d; Frequency: %d;", term, record.record_num, frequency
             )
 
-            extract = record.getElementsByTagName(
-                "EXTRACT"
-            )
+    utils.instrumentation.count("documents parsed", n_documents)
+    utils.instrumentation.count("tokens", n_tokens)
+    return inverted_list, max_freq_in_document
 
-            if abstract:
-                abstract = abstract[0].firstChild.nodeValue
-            elif extract:
-                abstract = extract[0].firstChild.nodeValue
-
-            if abstract:
-                abstract = utils.normalize_text(
-                    abstract, stopwords=True, steemer=steemer)
-                abstract = [term.strip() for term in abstract.split(" ")]
-                terms = set(abstract)
-                most_freq_term = max(terms, key=abstract.count)
-                max_freq_in_document[record_num] = abstract.count(
-                    most_freq_term
-                )
-                for term in abstract:
-                    inverted_list[term].append(record_num)
-                    logging.debug(
-                        "INVERTED LIST - LIST: Term: %s; Documents: %s;", term, inverted_list[term]
-                    )
 
-    return inverted_list, max_freq_in_document
+def __expand_postings(inverted_list: Dict[str, Dict[int, int]]) -> Iterator[Tuple[str, List[int]]]:
+    for term, postings in inverted_list.items():
+        yield term, [doc for doc in sorted(postings) for _ in range(postings[doc])]
 
 
-def __write_inverted_list_file(output_path: str, terms: List[Tuple]) -> None:
+def __write_inverted_list_file(output_path: str, inverted_list: Dict[str, Dict[int, int]]) -> None:
     """
     Write the inverted list to a CSV file.
 
+    Each row holds a term and the list of its record numbers, where a record number is
+    repeated as many times as the term occurs in the record. The lists are expanded one
+    term at a time while writing.
+
     Args:
     - output_path (str): the path to the output CSV file
-    - terms (List[Tuple]): the list of terms and their record numbers
+    - inverted_list (Dict[str, Dict[int, int]]): the terms and the frequency of the term in each record
 
     Returns:
     - None
     """
     logging.info("INVERTED LIST - Saving inverted list as %s", output_path)
     fieldnames = []
-    terms = list(zip(terms, terms.values()))
-    utils.write_to_csv(output_path, fieldnames, terms)
+    utils.write_to_csv(output_path, fieldnames, __expand_postings(inverted_list))
+
+
+def __read_shard(input_path: str, steemer: bool = False) -> Tuple[Dict[str, Dict[int, int]], Dict[int, int]]:
+    inverted_list, max_freq_in_document = __read_raw_documents_file(
+        input_path.strip(), defaultdict(dict), {}, steemer
+    )
+    return dict(inverted_list), max_freq_in_document
+
 
+def __merge_shards(shards: Iterable[Tuple[Dict[str, Dict[int, int]], Dict[int, int]]]) -> Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]:
+    """
+    Merge the partial inverted lists of several shards, keeping every posting list sorted by record number.
+    """
+    shard_postings = defaultdict(list)
+    max_freq_in_document = {}
+    for shard_inverted_list, shard_max_freq_in_document in shards:
+        for term, postings in shard_inverted_list.items():
+            shard_postings[term].append(sorted(postings.items()))
+        max_freq_in_document.update(shard_max_freq_in_document)
+
+    inverted_list = defaultdict(dict)
+    for term, postings in shard_postings.items():
+        inverted_list[term] = dict(heapq.merge(*postings))
+    return inverted_list, max_freq_in_document
 
-def parse(input_paths: List[str],  ouput_path: str, steemer: bool = False) -> Tuple[DefaultDict[str, List[int]], DefaultDict[int, float]]:
+
+@utils.instrumentation.timed
+def build(input_paths: List[str], steemer: bool = False, workers: int = 1) -> Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]:
+    """
+    Build the inverted list of one or more XML files containing documents, without saving it.
+
+    With more than one worker, every file is parsed in its own process into a partial inverted
+    list, and the partial lists are merged at the end.
+
+    Args:
+    - input_paths (List[str]): A list of paths to the input XML files.
+    - workers (int): The number of processes used to parse the files.
+
+    Returns:
+    - Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]: the inverted list and the maximum frequency of each document (see `parse`).
+    """
+    if workers > 1:
+        logging.info("INVERTED LIST - Parsing %d files with %d workers",
+                     len(input_paths), workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shards = []
+            for shard, measures in executor.map(utils.instrumentation.capture, [__read_shard] * len(input_paths),
+                                                input_paths, [steemer] * len(input_paths)):
+                utils.instrumentation.merge(measures)
+                shards.append(shard)
+            inverted_list, max_freq_in_document = __merge_shards(shards)
+    else:
+        inverted_list = defaultdict(dict)
+        max_freq_in_document = {}
+        for input_path in input_paths:
+            inverted_list, max_freq_in_document = __read_raw_documents_file(
+                input_path.strip(), inverted_list, max_freq_in_document, steemer
+            )
+    logging.info("INVERTED LIST - Inverted list found %d terms",
+                 len(inverted_list.values()))
+    return inverted_list, max_freq_in_document
+
+
+@utils.instrumentation.timed
+def stemmed_view(inverted_list: Dict[str, Dict[int, int]]) -> Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]:
+    """
+    Derive the stemmed inverted list from the unstemmed one, without reading the documents
+    again. The postings of the terms that share a stem are added together, which gives the
+    same inverted list as `build` with `steemer=True`, since stopwords are removed before
+    stemming.
+
+    Args:
+    - inverted_list (Dict[str, Dict[int, int]]): the unstemmed inverted list, as returned by `build`
+
+    Returns:
+    - Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]: the stemmed inverted list and the maximum frequency of each document.
+    """
+    stem = utils.get_normalizer(stopwords=True, steemer=True).stem
+    stemmed = defaultdict(lambda: defaultdict(int))
+    for term, postings in inverted_list.items():
+        stemmed_postings = stemmed[stem(term)]
+        for doc, frequency in postings.items():
+            stemmed_postings[doc] += frequency
+
+    inverted_list = defaultdict(dict)
+    max_freq_in_document = defaultdict(int)
+    for term, postings in stemmed.items():
+        inverted_list[term] = dict(postings)
+        for doc, frequency in postings.items():
+            if frequency > max_freq_in_document[doc]:
+                max_freq_in_document[doc] = frequency
+    logging.info("INVERTED LIST - Stemmed view has %d terms",
+                 len(inverted_list))
+    return inverted_list, dict(max_freq_in_document)
+
+
+@utils.instrumentation.timed
+def parse(input_paths: List[str],  ouput_path: str, steemer: bool = False, workers: int = 1, postings: Tuple[Dict[str, Dict[int, int]], Dict[int, int]] = None) -> Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]:
     """
     Parse one or more XML files containing documents, save the inverted list to a CSV file, and return two defaultdicts.
 
     The function reads one or more XML files containing documents, where each document consists of a number of fields.
-    The function then constructs an inverted index, where each term in the documents is associated with a list of record numbers.
+    The function then constructs an inverted index, where each term in the documents is associated with the record numbers it occurs in and its frequency in each of them.
     Additionally, for each document, the maximum frequency of a term in that document is also calculated and stored.
 
     Args:
     - input_paths (List[str]): A list of paths to the input XML files.
     - output_path (str): The path to the output CSV file for the inverted list.
+    - workers (int): The number of processes used to parse the files (see `build`).
+    - postings (Tuple[Dict[str, Dict[int, int]], Dict[int, int]]): an inverted list that was already built, for
+      example with `stemmed_view`. When given, the input files are not read and it is only saved.
 
     Returns:
-    - Tuple[DefaultDict[str, List[int]], DefaultDict[int, float]]: A tuple of two defaultdicts:
-        - The first defaultdict maps terms to a list of record numbers.
-        - The second defaultdict maps document numbers to their maximum term frequency.
+    - Tuple[DefaultDict[str, Dict[int, int]], Dict[int, int]]: A tuple of two dictionaries:
+        - The first maps terms to a dictionary of record numbers and term frequencies.
+        - The second maps document numbers to their maximum term frequency.
 
     Example:
     >>> inverted_list, max_freq_in_document = parse(['./data/documents.xml'], './data/inverted_list.csv')
     """
-    inverted_list = defaultdict(list)
-    max_freq_in_document = defaultdict(lambda: defaultdict(float))
-    for input_path in input_paths:
-        inverted_list, max_freq_in_document = __read_raw_documents_file(
-            input_path.strip(), inverted_list, max_freq_in_document, steemer
-        )
-    logging.info("INVERTED LIST - Inverted list found %d terms",
-                 len(inverted_list.values()))
+    if postings is None:
+        postings = build(input_paths, steemer, workers)
+    inverted_list, max_freq_in_document = postings
     __write_inverted_list_file(ouput_path, inverted_list)
     return inverted_list, max_freq_in_document
@@ -0,0 +1,382 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+from typing import List, Tuple, Union
+
+import numpy as np
+
+import parsers.compression
+import parsers.vocabulary
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+OFFSET_DTYPE = np.int64
+DOC_ID_DTYPE = np.int32
+WEIGHT_DTYPE = np.float32
+FLOAT_DTYPE = np.float64
+FREQUENCY_DTYPE = np.int32
+BYTE_DTYPE = parsers.compression.BYTE_DTYPE
+
+META_FILE = "meta.json"
+
+
+def _array_path(path: str, name: str) -> str:
+    return os.path.join(path, f"{name}.bin")
+
+
+def _map_array(path: str, name: str, dtype: np.dtype, length: int) -> np.ndarray:
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+    # A plain view of the mapping indexes faster than the memmap itself and keeps it open.
+    return np.memmap(_array_path(path, name), dtype=dtype, mode="r", shape=(length,)).view(np.ndarray)
+
+
+def term_upper_bounds(offsets: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray, norms: np.ndarray) -> np.ndarray:
+    """
+    The largest weight/norm ratio in the postings of each term, which bounds how much the
+    term can add to the similarity of any document. The ratios are computed in double
+    precision and the bounds are stored rounded up to the next single precision number, so
+    a bound is never below what the search computes for the term, rounding included.
+    """
+    n_postings = len(doc_ids)
+    upper_bounds = np.zeros(len(offsets) - 1, dtype=WEIGHT_DTYPE)
+    if n_postings:
+        doc_norms = norms[doc_ids]
+        ratios = np.divide(weights, doc_norms, out=np.zeros(n_postings), where=doc_norms > 0)
+        non_empty = offsets[:-1] < offsets[1:]
+        largest = np.maximum.reduceat(ratios, offsets[:-1][non_empty]).astype(WEIGHT_DTYPE)
+        upper_bounds[non_empty] = np.nextafter(largest, WEIGHT_DTYPE(np.inf))
+    return upper_bounds
+
+
+class Model:
+    """
+    A TF-IDF model stored as a term dictionary plus compressed postings.
+
+    The postings of the term with id `t` are the `offsets[t + 1] - offsets[t]` documents
+    holding it, split in blocks of `block_size` postings (see `parsers.compression`). Block
+    `b` is stored in `postings_bytes[block_starts[b]:block_starts[b + 1]]`, with the gaps
+    between its document ids followed by their term frequencies, and `block_last[b]` is its
+    last document id, which lets `postings` skip the blocks that cannot hold a given document.
+
+    The TF-IDF weights are not stored: the weight of a posting is its frequency, divided by
+    the largest frequency of its document (`max_frequencies`), times the IDF of the term,
+    computed when the postings are decoded. Document ids are dense indexes into
+    `doc_numbers` (the RECORDNUM of each document) and `norms` (the norm of each document
+    vector).
+
+    `live`, when given, marks which documents can be retrieved; the others were deleted
+    (see `parsers.segments`). `version` changes every time the model is written, so results
+    computed from an older model can be told apart (see `parsers.search.ResultCache`).
+    """
+
+    def __init__(self, terms: parsers.vocabulary.Vocabulary, offsets: np.ndarray, block_starts: np.ndarray,
+                 block_last: np.ndarray, postings_bytes: np.ndarray, idf: np.ndarray,
+                 max_frequencies: np.ndarray, upper_bounds: np.ndarray, doc_numbers: np.ndarray,
+                 norms: np.ndarray, live: np.ndarray = None, version: str = None,
+                 block_size: int = parsers.compression.BLOCK_SIZE):
+        self.terms = terms
+        self.offsets = offsets
+        self.block_starts = block_starts
+        self.block_last = block_last
+        self.postings_bytes = postings_bytes
+        self.idf = idf
+        self.max_frequencies = max_frequencies
+        self.upper_bounds = upper_bounds
+        self.doc_numbers = doc_numbers
+        self.norms = norms
+        self.live = live
+        self.version = version
+        self.block_size = block_size
+        self.block_offsets, self.block_sizes = parsers.compression.block_sizes(np.diff(offsets), block_size)
+        self._decoded = None
+
+    @property
+    def n_documents(self) -> int:
+        return len(self.doc_numbers)
+
+    def _weights(self, term_ids, doc_ids: np.ndarray, frequencies: np.ndarray) -> np.ndarray:
+        return ((frequencies / self.max_frequencies[doc_ids]) * self.idf[term_ids]).astype(WEIGHT_DTYPE)
+
+    def _decode(self, term_id: int, blocks: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decode the document ids and frequencies of every block of a term, or of the given
+        `blocks` only.
+        """
+        first, end = self.block_offsets[term_id], self.block_offsets[term_id + 1]
+        if blocks is None:
+            gaps, frequencies = parsers.compression.decode_blocks(
+                self.postings_bytes[self.block_starts[first]:self.block_starts[end]], self.block_sizes[first:end])
+            return np.cumsum(gaps), frequencies
+
+        sizes = self.block_sizes[blocks]
+        gaps, frequencies = parsers.compression.decode_blocks(self.postings_bytes[
+            parsers.compression.byte_ranges(self.block_starts[blocks], self.block_starts[blocks + 1])], sizes)
+        # The first gap of a block is counted from the last document of the block before it.
+        bases = np.where(blocks > first, self.block_last[blocks - 1], 0)
+        totals = np.cumsum(gaps)
+        starts = np.cumsum(sizes) - sizes
+        return totals - np.repeat(totals[starts] - gaps[starts] - bases, sizes), frequencies
+
+    def postings(self, term_id: int, candidates: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The document ids and weights of the postings of a term.
+
+        Args:
+        - term_id (int): the id of the term
+        - candidates (np.ndarray): if given, the sorted ids of the only documents of interest.
+          The blocks that cannot hold any of them are skipped, so some of the postings
+          returned may still be of other documents
+
+        Returns:
+        - Tuple[np.ndarray, np.ndarray]: the document ids and their TF-IDF weights
+        """
+        first, end = self.block_offsets[term_id], self.block_offsets[term_id + 1]
+        if candidates is None or end - first <= 1:
+            doc_ids, frequencies = self._decode(term_id)
+        else:
+            blocks = first + np.unique(np.searchsorted(self.block_last[first:end], candidates))
+            doc_ids, frequencies = self._decode(term_id, blocks[blocks < end])
+        return doc_ids, self._weights(term_id, doc_ids, frequencies)
+
+    def decode_terms(self, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decode the postings of the terms with ids `start` to `end` (excluded) at once.
+        """
+        first, last = self.block_offsets[start], self.block_offsets[end]
+        gaps, frequencies = parsers.compression.decode_blocks(
+            self.postings_bytes[self.block_starts[first]:self.block_starts[last]], self.block_sizes[first:last])
+        totals = np.cumsum(gaps)
+        counts = np.diff(self.offsets[start:end + 1])
+        starts = (np.cumsum(counts) - counts)[counts > 0]
+        # The first gap of a term is its first document id, so the sums restart there.
+        restarts = np.zeros(len(counts), dtype=np.int64)
+        restarts[counts > 0] = totals[starts] - gaps[starts]
+        return totals - np.repeat(restarts, counts), frequencies
+
+    def decode(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decode the postings of every term at once, as the CSR-style arrays of document ids
+        and frequencies that `offsets` indexes. They are kept after the first call.
+        """
+        if self._decoded is None:
+            self._decoded = self.decode_terms(0, len(self.offsets) - 1)
+        return self._decoded
+
+    @property
+    def doc_ids(self) -> np.ndarray:
+        return self.decode()[0]
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        return self.decode()[1]
+
+    @property
+    def weights(self) -> np.ndarray:
+        term_ids = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        return self._weights(term_ids, *self.decode())
+
+
+def replace_directory(path: str, final_path: str) -> None:
+    """
+    Move a directory that was just written to `final_path`, replacing the one there. A
+    process that has files of the previous directory open keeps reading them untouched.
+    """
+    shutil.rmtree(final_path + ".old", ignore_errors=True)
+    if os.path.exists(final_path):
+        os.rename(final_path, final_path + ".old")
+    os.rename(path, final_path)
+    shutil.rmtree(final_path + ".old", ignore_errors=True)
+
+
+class ModelWriter:
+    """
+    Writes a model directory one term at a time, so the postings never need to be held
+    in memory as a whole. Terms must be added in increasing order of id, and the document
+    norms and the term upper bounds are computed when the writer is closed. The `norms` of
+    the documents can be given instead, when the postings written are not all of them
+    (see `parsers.pruning`).
+
+    The model is written to a temporary directory that replaces `path` on close, so a
+    process that has the previous model open keeps reading it untouched.
+
+    Example:
+    >>> with ModelWriter("./data/parsed/modelo", [1, 2, 3], [4, 1, 2]) as writer:
+    ...     writer.add("FIBROSIS", 0.4, [0, 2], [2, 1])
+    """
+
+    def __init__(self, path: str, doc_numbers: List[int], max_frequencies: List[int],
+                 block_size: int = parsers.compression.BLOCK_SIZE, batch_postings: int = 1 << 16,
+                 norms: np.ndarray = None):
+        self.final_path = os.path.normpath(path)
+        self.path = self.final_path + ".tmp"
+        self.doc_numbers = np.asarray(doc_numbers, dtype=DOC_ID_DTYPE)
+        self.max_frequencies = np.asarray(max_frequencies, dtype=FREQUENCY_DTYPE)
+        self.block_size = block_size
+        self.batch_postings = batch_postings
+        self.squared_norms = np.zeros(len(doc_numbers), dtype=FLOAT_DTYPE)
+        self.norms = None if norms is None else np.asarray(norms, dtype=FLOAT_DTYPE)
+        self.terms = []
+        self.offsets = [0]
+        self.block_lengths = []
+        self.block_last = []
+        self.idf = []
+        self.pending = []
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        self.postings_file = open(_array_path(self.path, "postings"), "wb")
+
+    def add(self, term: str, idf: float, doc_ids: List[int], frequencies: List[int]) -> None:
+        self.terms.append(term)
+        self.offsets.append(self.offsets[-1] + len(doc_ids))
+        self.idf.append(idf)
+        self.pending.append((doc_ids, frequencies))
+        if self.offsets[-1] - self.offsets[-1 - len(self.pending)] >= self.batch_postings:
+            self.__flush()
+
+    def __flush(self) -> None:
+        """
+        Compress the terms added since the last flush together, since most terms have too
+        few postings to pay for the numpy calls of encoding them one by one.
+        """
+        if not self.pending:
+            return
+        counts = np.diff(self.offsets[-1 - len(self.pending):])
+        doc_ids = np.concatenate([np.asarray(ids, dtype=np.int64) for ids, _ in self.pending])
+        frequencies = np.concatenate([np.asarray(frequencies, dtype=np.int64) for _, frequencies in self.pending])
+        idf = np.repeat(np.asarray(self.idf[-len(self.pending):], dtype=FLOAT_DTYPE), counts)
+        self.pending = []
+
+        data, block_lengths, block_last = parsers.compression.encode_postings(
+            doc_ids, frequencies, counts, self.block_size)
+        self.postings_file.write(data.tobytes())
+        self.block_lengths.append(block_lengths)
+        self.block_last.append(block_last)
+        weights = ((frequencies / self.max_frequencies[doc_ids]) * idf).astype(WEIGHT_DTYPE)
+        np.add.at(self.squared_norms, doc_ids, weights.astype(FLOAT_DTYPE) ** 2)
+
+    def close(self) -> None:
+        self.__flush()
+        self.postings_file.close()
+        norms = np.sqrt(self.squared_norms) if self.norms is None else self.norms
+        offsets = np.asarray(self.offsets, dtype=OFFSET_DTYPE)
+        block_starts = np.cumsum(np.concatenate([[0], *self.block_lengths]), dtype=OFFSET_DTYPE)
+        block_last = np.concatenate([np.zeros(0, dtype=DOC_ID_DTYPE), *self.block_last]).astype(DOC_ID_DTYPE)
+        idf = np.asarray(self.idf, dtype=FLOAT_DTYPE)
+        n_postings, n_bytes = int(offsets[-1]), int(block_starts[-1])
+
+        model = Model(
+            terms=self.terms, offsets=offsets, block_starts=block_starts, block_last=block_last,
+            postings_bytes=_map_array(self.path, "postings", BYTE_DTYPE, n_bytes),
+            idf=idf, max_frequencies=self.max_frequencies, upper_bounds=None,
+            doc_numbers=self.doc_numbers, norms=norms, block_size=self.block_size
+        )
+        # The postings are decoded a batch of terms at a time, so they are never all in memory.
+        upper_bounds = []
+        bounds = np.r_[0, np.flatnonzero(np.diff(offsets // self.batch_postings)) + 1, len(self.terms)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            term_offsets = offsets[start:end + 1] - offsets[start]
+            doc_ids, frequencies = model.decode_terms(start, end)
+            weights = model._weights(np.repeat(np.arange(start, end), np.diff(term_offsets)), doc_ids, frequencies)
+            upper_bounds.append(term_upper_bounds(term_offsets, doc_ids, weights, norms))
+        upper_bounds = np.concatenate([np.zeros(0, dtype=WEIGHT_DTYPE), *upper_bounds])
+        del model
+
+        offsets.tofile(_array_path(self.path, "offsets"))
+        block_starts.tofile(_array_path(self.path, "block_starts"))
+        block_last.tofile(_array_path(self.path, "block_last"))
+        idf.tofile(_array_path(self.path, "idf"))
+        self.max_frequencies.tofile(_array_path(self.path, "max_frequencies"))
+        upper_bounds.tofile(_array_path(self.path, "upper_bounds"))
+        self.doc_numbers.tofile(_array_path(self.path, "doc_numbers"))
+        norms.tofile(_array_path(self.path, "norms"))
+        parsers.vocabulary.write(self.path, self.terms)
+        with open(os.path.join(self.path, META_FILE), "w", encoding="utf-8") as file:
+            json.dump({
+                "terms": len(self.terms),
+                "documents": len(self.doc_numbers),
+                "postings": n_postings,
+                "blocks": len(block_last),
+                "block_size": self.block_size,
+                "bytes": n_bytes,
+                "version": uuid.uuid4().hex
+            }, file)
+
+        replace_directory(self.path, self.final_path)
+        logging.info("MODEL - Saved %d terms, %d documents and %d postings (%d bytes) in %s",
+                     len(self.terms), len(self.doc_numbers), n_postings, n_bytes, self.final_path)
+
+    def __enter__(self) -> "ModelWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def load(path: str) -> Model:
+    """
+    Open a model directory written by `ModelWriter`. The arrays are memory-mapped, so
+    loading does not read the postings and the pages are shared between processes that
+    open the same model. The postings stay compressed in memory and each term is decoded
+    when it is searched.
+
+    Args:
+    - path (str): the path to the model directory
+
+    Returns:
+    - Model: the memory-mapped model
+    """
+    with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as file:
+        meta = json.load(file)
+    return Model(
+        terms=parsers.vocabulary.load(path),
+        offsets=_map_array(path, "offsets", OFFSET_DTYPE, meta["terms"] + 1),
+        block_starts=_map_array(path, "block_starts", OFFSET_DTYPE, meta["blocks"] + 1),
+        block_last=_map_array(path, "block_last", DOC_ID_DTYPE, meta["blocks"]),
+        postings_bytes=_map_array(path, "postings", BYTE_DTYPE, meta["bytes"]),
+        idf=_map_array(path, "idf", FLOAT_DTYPE, meta["terms"]),
+        max_frequencies=_map_array(path, "max_frequencies", FREQUENCY_DTYPE, meta["documents"]),
+        upper_bounds=_map_array(path, "upper_bounds", WEIGHT_DTYPE, meta["terms"]),
+        doc_numbers=_map_array(path, "doc_numbers", DOC_ID_DTYPE, meta["documents"]),
+        norms=_map_array(path, "norms", FLOAT_DTYPE, meta["documents"]),
+        version=meta.get("version"),
+        block_size=meta["block_size"]
+    )
+
+
+def write_json(path: str, model: Union[Model, List[Model]]) -> None:
+    """
+    Export a model as a human readable JSON file, for debugging.
+
+    Args:
+    - path (str): the path to the JSON file
+    - model (Union[Model, List[Model]]): the model to export, or the shards of a sharded model
+      (see `parsers.shards`), which are exported together
+
+    Saves:
+    - A JSON file with the keys "postings" (term -> document number -> TF-IDF weight),
+      "idf" (term -> IDF), "norms" (document number -> norm) and "upper_bounds"
+      (term -> largest weight/norm ratio of its postings).
+    """
+    logging.info("MODEL - Exporting model as %s", path)
+    postings, idf, norms, upper_bounds = {}, {}, {}, {}
+    for shard in (model if isinstance(model, list) else [model]):
+        doc_numbers = shard.doc_numbers.tolist()
+        terms = list(shard.terms)
+        for term_id, term in enumerate(terms):
+            doc_ids, weights = shard.postings(term_id)
+            postings.setdefault(term, {}).update(
+                (doc_numbers[doc], float(weight)) for doc, weight in zip(doc_ids.tolist(), weights))
+        idf.update(zip(terms, shard.idf.tolist()))
+        norms.update(zip(doc_numbers, shard.norms.tolist()))
+        for term, upper_bound in zip(terms, shard.upper_bounds.astype(FLOAT_DTYPE).tolist()):
+            upper_bounds[term] = max(upper_bound, upper_bounds.get(term, upper_bound))
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({
+            "postings": postings,
+            "idf": idf,
+            "norms": norms,
+            "upper_bounds": upper_bounds
+        }, file, sort_keys=True, indent=2)
@@ -0,0 +1,109 @@
+import logging
+from typing import Dict
+
+import numpy as np
+
+import parsers.model
+import utils.instrumentation
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+METHODS = ("term", "document", "threshold")
+
+
+def __ranks(groups: np.ndarray, impacts: np.ndarray) -> np.ndarray:
+    """
+    The rank of each posting among the postings of its group, by decreasing impact,
+    starting at 0. Ties keep the order of the postings.
+    """
+    order = np.lexsort((-impacts, groups))
+    counts = np.bincount(groups)
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return ranks
+
+
+def __kept(groups: np.ndarray, impacts: np.ndarray, level: float) -> np.ndarray:
+    """
+    Keep the best `level` fraction of the postings of each group, rounded up, so that every
+    group keeps at least one posting when `level` is above 0.
+    """
+    counts = np.bincount(groups)
+    return __ranks(groups, impacts) < np.ceil(counts[groups] * level)
+
+
+def impacts(model: parsers.model.Model) -> np.ndarray:
+    """
+    The impact of every posting of a model, in the order of `model.offsets`: its weight
+    divided by the norm of its document, which is how much it adds to the cosine of the
+    document with a query holding its term once (see `parsers.search`).
+    """
+    norms = model.norms[model.doc_ids]
+    return np.divide(model.weights, norms, out=np.zeros(len(norms)), where=norms > 0)
+
+
+@utils.instrumentation.timed
+def prune(model_path: str, output_path: str, method: str = "term", level: float = 0.5) -> Dict:
+    """
+    Static index pruning: drop the postings of a model that barely change the ranking of
+    the documents, ranked by their impact (see `impacts`).
+
+    - "term": term-centric pruning, which keeps the `level` fraction of the postings of each
+      term with the largest impacts, so no term is left without postings.
+    - "document": document-centric pruning, which keeps the `level` fraction of the postings
+      of each document with the largest impacts, so no document is left without postings.
+    - "threshold": keeps the postings whose impact is at least `level`, in every term.
+
+    The pruned model keeps the IDF of its terms and the norms of its documents, so every
+    posting left adds to the similarity of its document as much as before, and a document
+    scores at most what it scored with the whole model. Terms left without postings are
+    dropped, and the upper bounds are computed again from the postings left.
+
+    Args:
+    - model_path (str): the path to the model directory written by the indexer
+    - output_path (str): the path to the pruned model directory, which may be `model_path`
+    - method (str): "term", "document" or "threshold"
+    - level (float): the fraction of postings to keep for "term" and "document", above 0 and at
+      most 1, or the smallest impact kept for "threshold"
+
+    Returns:
+    - Dict: the number of postings and terms of the model before and after pruning
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown pruning method {method}, expected one of {METHODS}")
+    if method != "threshold" and not 0 < level <= 1:
+        raise ValueError(f"The {method} pruning keeps a fraction of the postings above 0 and at most 1, got {level}")
+    model = parsers.model.load(model_path)
+    n_terms = len(model.offsets) - 1
+    term_ids = np.repeat(np.arange(n_terms), np.diff(model.offsets))
+    posting_impacts = impacts(model)
+    if method == "term":
+        kept = __kept(term_ids, posting_impacts, level)
+    elif method == "document":
+        kept = __kept(model.doc_ids, posting_impacts, level)
+    else:
+        kept = posting_impacts >= level
+
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(term_ids[kept], minlength=n_terms))))
+    doc_ids, frequencies = model.doc_ids[kept], model.frequencies[kept]
+    terms = list(model.terms)
+    with parsers.model.ModelWriter(output_path, model.doc_numbers, model.max_frequencies,
+                                   model.block_size, norms=model.norms) as writer:
+        for term_id in np.flatnonzero(np.diff(offsets)).tolist():
+            start, end = offsets[term_id], offsets[term_id + 1]
+            writer.add(terms[term_id], float(model.idf[term_id]), doc_ids[start:end], frequencies[start:end])
+
+    stats = {
+        "method": method,
+        "level": level,
+        "postings": len(kept),
+        "kept_postings": int(kept.sum()),
+        "terms": n_terms,
+        "kept_terms": int(np.count_nonzero(np.diff(offsets))),
+    }
+    utils.instrumentation.count("postings pruned", stats["postings"] - stats["kept_postings"])
+    logging.info("PRUNING - Kept %d of %d postings (%.1f%%) and %d of %d terms of %s with %s pruning at %s",
+                 stats["kept_postings"], stats["postings"],
+                 100 * stats["kept_postings"] / max(stats["postings"], 1),
+                 stats["kept_terms"], stats["terms"], model_path, method, level)
+    return stats
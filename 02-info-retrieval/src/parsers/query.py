@@ -1,8 +1,9 @@
 import logging
-import xml.dom.minidom
 from typing import List, Tuple
 
+import parsers.reader
 import utils
+import utils.instrumentation
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
@@ -26,42 +27,27 @@ def __read_raw_query_file(input_path: str, steemer: bool = False) -> Tuple[List[
     logging.info("QUERY PARSER - Reading file %s", input_path)
     queries = []
     expected = []
-    with xml.dom.minidom.parse(input_path) as doc:
-        logging.info("QUERY PARSER - Parsing %s", input_path)
-        n_queries = 0
-        for query in doc.getElementsByTagName("QUERY"):
-            n_queries += 1
-            query_number = query.getElementsByTagName(
-                "QueryNumber"
-            )[0].firstChild.nodeValue
-            query_number = int(query_number.strip())
-
-            query_text = query.getElementsByTagName(
-                "QueryText"
-            )[0].firstChild.nodeValue
-
-            query_text = utils.normalize_text(
-                query_text, stopwords=False, steemer=steemer)
-
-            queries.append((query_number, query_text))
-            logging.debug("QUERY PARSER - QUERIES FILE: QueryNumber: %d; QueryText: %s",
-                          query_number, query_text)
-
-            documents = query.getElementsByTagName("Records")[0]
-            for document in documents.getElementsByTagName("Item"):
-                document_number = document.firstChild.nodeValue
-                document_number = int(document_number.strip())
-
-                document_score = document.getAttribute("score")
-                document_score = sum(map(lambda x: int(x) > 0, document_score))
-
-                expected.append(
-                    (query_number, document_number, document_score)
-                )
-                logging.debug("QUERY PARSER - EXPECTED FILE: QueryNumber: %d; DocNumber: %d; DocScore: %d;",
-                              query_number, document_number, document_score)
+    n_queries = 0
+    normalizer = utils.get_normalizer(stopwords=True, steemer=steemer)
+    for query in parsers.reader.read_queries(input_path):
+        n_queries += 1
+        query_text = " ".join(normalizer.normalize(query.text))
+
+        queries.append((query.query_number, query_text))
+        logging.debug("QUERY PARSER - QUERIES FILE: QueryNumber: %d; QueryText: %s",
+                      query.query_number, query_text)
+
+        for document_number, document_score in query.records:
+            document_score = sum(map(lambda x: int(x) > 0, document_score))
+
+            expected.append(
+                (query.query_number, document_number, document_score)
+            )
+            logging.debug("QUERY PARSER - EXPECTED FILE: QueryNumber: %d; DocNumber: %d; DocScore: %d;",
+                          query.query_number, document_number, document_score)
 
     logging.info("QUERY PARSER - Total queries parsed: %d", n_queries)
+    utils.instrumentation.count("queries parsed", n_queries)
     return queries, expected
 
 
@@ -115,6 +101,7 @@ def __write_expected_file(output_path: str, expected: List[Tuple]) -> None:
     utils.write_to_csv(output_path, fieldnames, expected)
 
 
+@utils.instrumentation.timed
 def parse(input_path: str,  ouput_query_path: str, ouput_expected_path: str, steemer: bool = False) -> None:
     """
     Parse an XML file containing queries and their expected results.
@@ -0,0 +1,73 @@
+import logging
+import xml.etree.ElementTree as ET
+from typing import Iterator, List, NamedTuple, Tuple
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class Record(NamedTuple):
+    record_num: int
+    text: str
+
+
+class Query(NamedTuple):
+    query_number: int
+    text: str
+    records: List[Tuple[int, str]]
+
+
+def __iter_elements(input_path: str, tag: str) -> Iterator[ET.Element]:
+    """
+    Stream the elements named `tag` of an XML file.
+
+    Every element is cleared from the tree after it is consumed, so memory is bounded by a
+    single element regardless of the size of the file.
+    """
+    context = ET.iterparse(input_path, events=("start", "end"))
+    _, root = next(context)
+    for event, element in context:
+        if event == "end" and element.tag == tag:
+            yield element
+            root.clear()
+
+
+def read_records(input_path: str) -> Iterator[Record]:
+    """
+    Stream the RECORDs of a CFC collection file.
+
+    Args:
+    - input_path (str): the path to the XML file to read
+
+    Returns:
+    - Iterator[Record]: the RECORDNUM of each record and the text of its ABSTRACT, or of its
+      EXTRACT when it has no ABSTRACT. Records with neither are skipped.
+
+    Example:
+    >>> for record in read_records('./data/raw/cf74.xml'):
+    ...     print(record.record_num, record.text[:20])
+    """
+    for record in __iter_elements(input_path, "RECORD"):
+        text = record.findtext("ABSTRACT")
+        if text is None:
+            text = record.findtext("EXTRACT")
+        if text:
+            yield Record(int(record.findtext("RECORDNUM").strip()), text)
+
+
+def read_queries(input_path: str) -> Iterator[Query]:
+    """
+    Stream the QUERYs of a CFC queries file.
+
+    Args:
+    - input_path (str): the path to the XML file to read
+
+    Returns:
+    - Iterator[Query]: the number and text of each query, and the number and score attribute
+      of each Item of its Records.
+    """
+    for query in __iter_elements(input_path, "QUERY"):
+        records = [
+            (int(item.text.strip()), item.get("score"))
+            for item in query.find("Records").iter("Item")
+        ]
+        yield Query(int(query.findtext("QueryNumber").strip()), query.findtext("QueryText"), records)
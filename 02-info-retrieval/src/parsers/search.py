@@ -1,17 +1,30 @@
 import csv
-import json
 import logging
-
-from typing import List, Dict, Tuple
+import math
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Hashable, Iterator, Optional, Tuple
 
 import numpy as np
+import scipy.sparse
 
-import utils
+import parsers.model
+import parsers.segments
+import parsers.shards
+import utils.instrumentation
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
+# The models opened by a search worker process, by path, so it opens each one once for all
+# the chunks of queries it scores.
+__worker_models = {}
+
 
-def __read_parsed_query_file(input_path: str, steemer: bool = False) -> Dict[int, str]:
+def __read_parsed_query_file(input_path: str) -> Dict[int, List[str]]:
+    """
+    Read the queries file written by the query processor. Its texts are already normalized
+    (and stemmed, for a stemmed model), so they are only split into terms.
+    """
     logging.info(
         "SEARCH PARSER - Reading queries file %s", input_path
     )
@@ -19,65 +32,484 @@ def __read_parsed_query_file(input_path: str, steemer: bool = False) -> Dict[int
     with open(input_path, "r", encoding="utf-8") as file:
         reader = csv.DictReader(file, delimiter=";")
         for row in reader:
-            queries[int(row["QueryNumber"])] = utils.normalize_text(
-                row["QueryText"], stopwords=True, steemer=steemer
-            ).split(" ")
+            queries[int(row["QueryNumber"])] = row["QueryText"].split()
     return queries
 
 
-def __read_model(input_path: str) -> Dict[str, Dict[str, float]]:
+def __read_model(input_path: str) -> List[parsers.model.Model]:
+    """
+    Open a model directory written by the indexer, every shard of a sharded model (see
+    `parsers.shards`) or every segment of an incremental index (see `parsers.segments`).
+    """
     logging.info(
-        "SEARCH PARSER - Reading model file %s", input_path
+        "SEARCH PARSER - Opening model %s", input_path
     )
-    with open(input_path, "r", encoding="utf-8") as file:
-        model = json.load(file)
-    return model
+    if parsers.segments.is_index(input_path):
+        return parsers.segments.load(input_path)
+    if parsers.shards.is_index(input_path):
+        return parsers.shards.load(input_path)
+    model = parsers.model.load(input_path)
+    logging.info(
+        "SEARCH PARSER - Model has %d terms and %d documents",
+        len(model.terms), model.n_documents
+    )
+    return [model]
+
+
+def __live_documents(doc_ids: np.ndarray, scores: np.ndarray, model: parsers.model.Model) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Drop the deleted documents of a scored model and return the numbers of the others.
+    """
+    if model.live is not None:
+        live = model.live[doc_ids]
+        doc_ids, scores = doc_ids[live], scores[live]
+    return model.doc_numbers[doc_ids], scores
+
+
+def __contributions(doc_ids: np.ndarray, weights: np.ndarray, query_weight: float, model: parsers.model.Model) -> np.ndarray:
+    norms = model.norms[doc_ids]
+    return np.divide(query_weight * weights, norms, out=np.zeros(len(doc_ids)), where=norms > 0)
+
+
+def __accumulate(query: Dict[str, int], model: parsers.model.Model, top_k: int = 0, max_score: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Term-at-a-time scoring: accumulates the cosine between the query and every document
+    that shares at least one term with it, visiting only the postings of the query terms.
+    Each occurrence of a term in the query has weight 1.
+
+    With `max_score` and a `top_k`, terms are visited in decreasing order of their upper
+    bound. Once the k-th best accumulated score exceeds the sum of the upper bounds of the
+    terms not yet visited, a document without an accumulator can no longer enter the top k,
+    not even tied with the k-th, so the remaining terms only update the documents that are
+    already accumulated. The results are then the same as without `max_score`.
+
+    Returns the ids of the accumulated documents and their similarities.
+    """
+    query_norm = math.sqrt(sum(n ** 2 for n in query.values()))
+    term_ids = ((model.terms.get(term), query_weight / query_norm) for term, query_weight in query.items())
+    terms = sorted(
+        ((term_id, query_weight) for term_id, query_weight in term_ids if term_id is not None),
+        key=lambda x: x[1] * model.upper_bounds[x[0]], reverse=True
+    )
+    # remaining[i] bounds what the terms from the i-th on can add. It is summed from the
+    # smallest bound up, since subtracting each bound from the total could round it too low.
+    bounds = np.array([query_weight * float(model.upper_bounds[term_id]) for term_id, query_weight in terms])
+    remaining = np.r_[np.cumsum(bounds[::-1])[::-1], 0.0]
+
+    scores = np.zeros(model.n_documents)
+    accumulated = np.zeros(model.n_documents, dtype=bool)
+    for i, (term_id, query_weight) in enumerate(terms):
+        n_accumulated = np.count_nonzero(accumulated)
+        if max_score and 0 < top_k <= n_accumulated and \
+                np.partition(scores[accumulated], n_accumulated - top_k)[n_accumulated - top_k] > remaining[i]:
+            # Only the blocks that may hold an accumulated document are decoded.
+            doc_ids, weights = model.postings(term_id, candidates=np.flatnonzero(accumulated))
+            mask = accumulated[doc_ids]
+            doc_ids, weights = doc_ids[mask], weights[mask]
+            scores[doc_ids] += __contributions(doc_ids, weights, query_weight, model)
+        else:
+            doc_ids, weights = model.postings(term_id)
+            scores[doc_ids] += __contributions(doc_ids, weights, query_weight, model)
+            accumulated[doc_ids] = True
+
+    doc_ids = np.flatnonzero(accumulated)
+    return doc_ids, scores[doc_ids]
+
+
+def __count_scored(doc_numbers: List[np.ndarray], scores: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Join the documents scored by each model for a query, counting them.
+    """
+    doc_numbers, scores = np.concatenate(doc_numbers), np.concatenate(scores)
+    utils.instrumentation.count("queries scored")
+    utils.instrumentation.observe("documents scored per query", len(doc_numbers))
+    return doc_numbers, scores
+
+
+def __rank(doc_numbers: np.ndarray, scores: np.ndarray, top_k: int = 0) -> List[Tuple[int, float]]:
+    if 0 < top_k < len(doc_numbers):
+        selected = np.argpartition(-scores, top_k - 1)[:top_k]
+        doc_numbers, scores = doc_numbers[selected], scores[selected]
+    order = np.lexsort((doc_numbers, -scores))
+    return list(zip(doc_numbers[order].tolist(), scores[order].tolist()))
+
+
+def __results(query: List[str], models: List[parsers.model.Model], top_k: int = 0, max_score: bool = False) -> List[Tuple[int, float]]:
+    """
+    Score a query against every model and rank the documents of all of them together.
+    """
+    query = Counter(query)
+    doc_numbers, scores = [], []
+    for model in models:
+        model_doc_numbers, model_scores = __live_documents(
+            *__accumulate(query, model, top_k, max_score), model)
+        doc_numbers.append(model_doc_numbers)
+        scores.append(model_scores)
+    return __rank(*__count_scored(doc_numbers, scores), top_k)
+
+
+def __term_document_matrix(model: parsers.model.Model) -> scipy.sparse.csr_matrix:
+    """
+    Build the term x document matrix of the model, with every weight already divided by the
+    norm of its document. The CSR arrays are the postings of the model, decoded at once.
+    """
+    norms = model.norms[model.doc_ids]
+    weights = np.divide(model.weights, norms, out=np.zeros(len(norms)), where=norms > 0)
+    return scipy.sparse.csr_matrix(
+        (weights, model.doc_ids, model.offsets),
+        shape=(len(model.terms), model.n_documents)
+    )
+
+
+def __query_matrix(queries: List[List[str]], model: parsers.model.Model) -> scipy.sparse.csr_matrix:
+    """
+    Build the query x term matrix of a batch of queries, each row normalized to unit length.
+    """
+    rows, columns, values = [], [], []
+    for row, query in enumerate(queries):
+        query = Counter(query)
+        query_norm = math.sqrt(sum(n ** 2 for n in query.values()))
+        for term, query_weight in query.items():
+            term_id = model.terms.get(term)
+            if term_id is not None:
+                rows.append(row)
+                columns.append(term_id)
+                values.append(query_weight / query_norm)
+    return scipy.sparse.csr_matrix(
+        (values, (rows, columns)), shape=(len(queries), len(model.terms))
+    )
+
+
+def __batch_results(queries: Dict[int, List[str]], models: List[parsers.model.Model], top_k: int = 0, batch_size: int = 1024) -> Iterator[Tuple[int, List[Tuple[int, float]]]]:
+    """
+    Score the queries `batch_size` at a time, each batch with a single sparse product
+    between its query matrix and the term x document matrix of each model.
+
+    Yields the query number and its ranked results, in the order of `queries`.
+    """
+    matrices = [__term_document_matrix(model) for model in models]
+    query_numbers = list(queries.keys())
+    for start in range(0, len(query_numbers), batch_size):
+        batch = query_numbers[start:start + batch_size]
+        all_scores = [
+            (__query_matrix([queries[i] for i in batch], model) @ matrix).tocsr()
+            for model, matrix in zip(models, matrices)
+        ]
+        for row, i in enumerate(batch):
+            doc_numbers, scores = [], []
+            for model, batch_scores in zip(models, all_scores):
+                begin, end = batch_scores.indptr[row], batch_scores.indptr[row + 1]
+                model_doc_numbers, model_scores = __live_documents(
+                    batch_scores.indices[begin:end], batch_scores.data[begin:end], model)
+                doc_numbers.append(model_doc_numbers)
+                scores.append(model_scores)
+            yield i, __rank(*__count_scored(doc_numbers, scores), top_k)
+
+
+def __worker_results(model_path: str, queries: List[Tuple[int, List[str]]], top_k: int = 0, max_score: bool = False) -> List[Tuple[int, List[Tuple[int, float]]]]:
+    """
+    Score a chunk of queries in a worker process, against the model it opened itself.
+    """
+    if model_path not in __worker_models:
+        __worker_models[model_path] = __read_model(model_path)
+    models = __worker_models[model_path]
+    return [(i, __results(query, models, top_k, max_score)) for i, query in queries]
+
+
+def __parallel_results(queries: Dict[int, List[str]], model_path: str, top_k: int = 0, max_score: bool = False, workers: int = 2, chunk_size: int = 256) -> Iterator[Tuple[int, List[Tuple[int, float]]]]:
+    """
+    Score the queries in `workers` processes, in chunks of up to `chunk_size` queries with
+    at least four chunks per process, so that they share the work evenly.
+
+    The workers do not receive the model: each one memory-maps the model files, so all of
+    them read the same pages of the operating system cache and the index takes the memory of
+    a single copy, however many processes search it.
+
+    Yields the query number and its ranked results, in the order of `queries`.
+    """
+    items = list(queries.items())
+    chunk_size = max(1, min(chunk_size, -(-len(items) // (4 * workers))))
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    logging.info(
+        "SEARCH PARSER - Scoring %d queries in %d chunks with %d processes", len(items), len(chunks), workers
+    )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for results, measures in executor.map(
+                utils.instrumentation.capture, [__worker_results] * len(chunks), [model_path] * len(chunks),
+                chunks, [top_k] * len(chunks), [max_score] * len(chunks)):
+            utils.instrumentation.merge(measures)
+            yield from results
+
+
+def __scatter_gather(queries: Dict[int, List[str]], index_path: str, top_k: int = 0, max_score: bool = False, chunk_size: int = 256) -> Iterator[Tuple[int, List[Tuple[int, float]]]]:
+    """
+    Search a sharded model (see `parsers.shards`) with one process per shard, standing in for
+    the nodes that would hold them. Each chunk of up to `chunk_size` queries is sent to every
+    shard, which ranks the top k documents of each query among its own documents, and the top
+    k lists of the shards are merged into the top k of the whole collection.
+
+    The shards are searched with the IDF of the whole collection, so the merged results are
+    the ones of the same model unsharded, except for the order of documents with equal
+    similarities.
+
+    Yields the query number and its ranked results, in the order of `queries`.
+    """
+    shard_paths = parsers.shards.shard_paths(index_path)
+    items = list(queries.items())
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    logging.info(
+        "SEARCH PARSER - Scoring %d queries in %d chunks with %d shards", len(items), len(chunks), len(shard_paths)
+    )
+    nodes = [ProcessPoolExecutor(max_workers=1) for _ in shard_paths]
+    try:
+        # Every chunk is queued on every node at once, so the nodes never wait for the merge.
+        futures = [
+            [node.submit(utils.instrumentation.capture, __worker_results, shard_path, chunk, top_k, max_score)
+             for node, shard_path in zip(nodes, shard_paths)]
+            for chunk in chunks
+        ]
+        for chunk, chunk_futures in zip(chunks, futures):
+            shard_results = []
+            for future in chunk_futures:
+                results, measures = future.result()
+                utils.instrumentation.merge(measures)
+                shard_results.append(results)
+            for row, (i, _) in enumerate(chunk):
+                results = [result for shard in shard_results for result in shard[row][1]]
+                yield i, __rank(np.array([doc for doc, _ in results], dtype=np.int64),
+                                np.array([similarity for _, similarity in results], dtype=float), top_k)
+    finally:
+        for node in nodes:
+            node.shutdown(cancel_futures=True)
+
+
+class ResultCache:
+    """
+    A least recently used cache of ranked results.
+
+    A query is keyed by its sorted bag of normalized terms, so queries that only differ in
+    case, accents, stopwords, inflections (on a stemmed model) or word order share an entry.
+    The key also holds the version of the model, and the entries of older versions are
+    dropped as soon as a newer model is searched.
+
+    Entries are evicted when there are more than `max_entries` of them, or when they hold
+    more than `max_results` results in total.
+
+    Example:
+    >>> cache = ResultCache(max_entries=1000)
+    >>> search(["CYSTIC", "FIBROSIS"], models, 10, cache=cache)
+    >>> cache.hit_rate
+    """
+
+    def __init__(self, max_entries: int = 10000, max_results: int = 1000000):
+        self.max_entries = max_entries
+        self.max_results = max_results
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(query: List[str], top_k: int, max_score: bool) -> Hashable:
+        return tuple(sorted(query)), top_k, max_score
+
+    def get(self, key: Hashable, version: Optional[str]) -> Optional[List[Tuple[int, float]]]:
+        if version != self.version:
+            self.invalidate()
+            self.version = version
+        results = self.entries.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return results
+
+    def put(self, key: Hashable, version: Optional[str], results: List[Tuple[int, float]]) -> None:
+        if version != self.version:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = results
+        self.size += len(results)
+        while len(self.entries) > self.max_entries or (self.size > self.max_results and len(self.entries) > 1):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
 
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self.entries),
+            "results": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
 
-def __calc_weights(query: List[str], document: Dict[str, float]) -> np.array:
-    weights = []
-    for term in query:
-        try:
-            weights.append(document[term])
-        except KeyError:
-            weights.append(0)
 
-    return np.array(weights)
+def open_model(model_path: str) -> List[parsers.model.Model]:
+    """
+    Open a model or an incremental index once, to run many queries against it with
+    `search` and `search_batch`.
 
+    Args:
+    - model_path (str): the path to the model directory written by the indexer, or to an
+      incremental index (see `parsers.segments`). The shards of a sharded model (see
+      `parsers.shards`) are all opened in this process
 
-def __calc_similarity(query_weights: np.array, document_weights: np.array) -> float:
-    a = document_weights.dot(query_weights)
-    b = (np.linalg.norm(document_weights) * np.linalg.norm(query_weights))
-    if b == 0:
-        return 0
-    return a/b
+    Returns:
+    - List[Model]: the memory-mapped models, one per segment or shard
+    """
+    return __read_model(model_path.strip())
 
 
-def __results(query: List[str], model: Dict[str, Dict[str, float]]) -> List[Tuple[int, float]]:
-    documents_similarity = {}
-    query_weights = np.array([1] * len(query))
-    for doc, weights in model.items():
-        document_weights = __calc_weights(query, weights)
-        documents_similarity[doc] = __calc_similarity(
-            query_weights, document_weights)
+def search(query: List[str], models: List[parsers.model.Model], top_k: int = 0, max_score: bool = False, cache: ResultCache = None) -> List[Tuple[int, float]]:
+    """
+    Rank the documents of open models for one query.
 
-    results = sorted(documents_similarity.items(),
-                     key=lambda x: x[1], reverse=True)
+    Args:
+    - query (List[str]): the normalized terms of the query (see `utils.Normalizer`)
+    - models (List[Model]): the models returned by `open_model`
+    - top_k (int): how many documents to keep. 0 keeps every scored document
+    - max_score (bool): whether to skip documents that cannot enter the top k
+    - cache (ResultCache): if given, the results are looked up in and saved to it
+
+    Returns:
+    - List[Tuple[int, float]]: the document numbers and their similarities, best first
+    """
+    if cache is None:
+        return __results(query, models, top_k, max_score)
+    key = cache.key(query, top_k, max_score)
+    version = models[0].version if models else None
+    results = cache.get(key, version)
+    if results is None:
+        results = __results(query, models, top_k, max_score)
+        cache.put(key, version, results)
     return results
 
 
-def retrieve_documents(queries_path: str, output_path: str, model_path: str, steemer: str = False) -> None:
-    queries = __read_parsed_query_file(queries_path.strip(), steemer=steemer)
-    model = __read_model(model_path.strip())
+def search_batch(queries: Dict[int, List[str]], models: List[parsers.model.Model], top_k: int = 0) -> Iterator[Tuple[int, List[Tuple[int, float]]]]:
+    """
+    Rank the documents of open models for many queries, with sparse matrix products
+    (see `__batch_results`).
+
+    Args:
+    - queries (Dict[int, List[str]]): the normalized terms of each query, by query number
+    - models (List[Model]): the models returned by `open_model`
+    - top_k (int): how many documents to keep per query. 0 keeps every scored document
+
+    Returns:
+    - Iterator[Tuple[int, List[Tuple[int, float]]]]: the query number and its ranked results, in the order of `queries`
+    """
+    return __batch_results(queries, models, top_k)
+
+
+class ResultWriter:
+    """
+    A streaming sink for ranked results, which keeps one file handle open for the whole run
+    and writes the rows in batches.
+
+    Two formats are supported:
+    - "csv": the "QueryNumber;Result" file, with one [document, rank, similarity] list per row
+      and ranks starting at 0.
+    - "trec": a TREC run file, with the plain columns "query Q0 document rank similarity tag"
+      separated by spaces and ranks starting at 1.
+
+    Example:
+    >>> with ResultWriter("./data/parsed/resultados.csv") as writer:
+    ...     writer.write(1, [(568, 0.76), (533, 0.75)])
+    """
+    FORMATS = ("csv", "trec")
+
+    def __init__(self, output_path: str, run_format: str = "csv", batch_size: int = 10000, tag: str = "tfidf"):
+        if run_format not in self.FORMATS:
+            raise ValueError(f"Unknown run format {run_format}, expected one of {self.FORMATS}")
+        self.run_format = run_format
+        self.batch_size = batch_size
+        self.tag = tag
+        self.rows = []
+        self.file = open(output_path, "w", encoding="utf-8", newline="")
+        if run_format == "csv":
+            self.writer = csv.writer(self.file, delimiter=";", quotechar="\"")
+            self.writer.writerow(["QueryNumber", "Result"])
+        else:
+            self.writer = csv.writer(self.file, delimiter=" ", quoting=csv.QUOTE_NONE)
+
+    def write(self, query_number: int, results: List[Tuple[int, float]]) -> None:
+        if self.run_format == "csv":
+            self.rows.extend((query_number, [doc, rank, similarity])
+                             for rank, (doc, similarity) in enumerate(results))
+        else:
+            self.rows.extend((query_number, "Q0", doc, rank, similarity, self.tag)
+                             for rank, (doc, similarity) in enumerate(results, start=1))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        self.writer.writerows(self.rows)
+        self.rows = []
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+@utils.instrumentation.timed
+def retrieve_documents(queries_path: str, output_path: str, model_path: str, top_k: int = 0, max_score: bool = False, batch: bool = False, run_format: str = "csv", workers: int = 1) -> None:
+    """
+    Run every query of a parsed queries file against a model and save the ranked results.
+
+    Args:
+    - queries_path (str): the path to the parsed queries CSV file
+    - output_path (str): the path to the results file
+    - model_path (str): the path to the model directory written by the indexer, or to an
+      incremental index (see `parsers.segments`). A sharded model (see `parsers.shards`) is
+      searched by one process per shard (see `__scatter_gather`)
+    - top_k (int): how many documents to keep per query, selected with a partial sort. 0 keeps every scored document
+    - max_score (bool): whether to skip documents that cannot enter the top k (see `__accumulate`)
+    - batch (bool): whether to score the queries together with sparse matrix products (see `__batch_results`).
+      `max_score` does not apply to this mode
+    - run_format (str): the format of the results file, "csv" or "trec" (see `ResultWriter`)
+    - workers (int): the number of processes that score the queries, all of them searching the
+      same memory-mapped model (see `__parallel_results`). It does not apply to `batch`, whose
+      term x document matrix would be decoded again in every process, nor to sharded models
+
+    Returns:
+    - None
+    """
+    queries = __read_parsed_query_file(queries_path.strip())
+    if batch:
+        all_results = __batch_results(queries, __read_model(model_path.strip()), top_k)
+    elif parsers.shards.is_index(model_path.strip()):
+        all_results = __scatter_gather(queries, model_path.strip(), top_k, max_score)
+    elif workers > 1:
+        all_results = __parallel_results(queries, model_path.strip(), top_k, max_score, workers)
+    else:
+        models = __read_model(model_path.strip())
+        all_results = ((i, __results(query, models, top_k, max_score))
+                       for i, query in queries.items())
+
     logging.info(
         "SEARCH PARSER - Saving query results fiel as %s", output_path
     )
-    utils.write_to_csv(output_path, ["QueryNumber", "Result"], [])
-    for i, query in queries.items():
-        results = __results(query, model)
-        rank = 0
-        for doc, result in results:
-            utils.write_to_csv(output_path, [], [
-                (i, [int(doc), rank, result])
-            ], mode="a")
-            rank += 1
+    with ResultWriter(output_path, run_format) as writer:
+        for i, results in all_results:
+            writer.write(i, results)
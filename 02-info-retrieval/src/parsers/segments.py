@@ -0,0 +1,312 @@
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+import parsers.inverted_list
+import parsers.model
+import utils.instrumentation
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+MANIFEST_FILE = "manifest.json"
+MERGE_THRESHOLD = 8
+
+# Guards every read-modify-write of a manifest made by this process, including the ones
+# of a background merge. Indexes shared between processes need an external lock.
+__lock = threading.RLock()
+
+
+def __manifest_path(index_path: str) -> str:
+    return os.path.join(index_path, MANIFEST_FILE)
+
+
+def is_index(path: str) -> bool:
+    return os.path.isfile(__manifest_path(path))
+
+
+def __read_manifest(index_path: str) -> Dict:
+    if not is_index(index_path):
+        return {"segments": [], "next_segment": 1, "documents": 0, "df": {}}
+    with open(__manifest_path(index_path), "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def __write_manifest(index_path: str, manifest: Dict) -> None:
+    """
+    Replace the manifest atomically, so a reader sees either the old or the new index.
+    Every write gives the index a new version.
+    """
+    os.makedirs(index_path, exist_ok=True)
+    manifest["version"] = uuid.uuid4().hex
+    temporary_path = __manifest_path(index_path) + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, sort_keys=True)
+    os.replace(temporary_path, __manifest_path(index_path))
+
+
+def __term_ids(model: parsers.model.Model) -> np.ndarray:
+    """
+    The term id of every posting of a model.
+    """
+    return np.repeat(np.arange(len(model.terms)), np.diff(model.offsets))
+
+
+def __tombstone(index_path: str, manifest: Dict, doc_numbers: Iterable[int]) -> int:
+    """
+    Mark every live copy of `doc_numbers` as deleted and take its terms out of the live df.
+
+    Returns the number of documents deleted.
+    """
+    doc_numbers = np.asarray(sorted(set(doc_numbers)), dtype=parsers.model.DOC_ID_DTYPE)
+    deleted = 0
+    for segment in manifest["segments"]:
+        model = parsers.model.load(os.path.join(index_path, segment["name"]))
+        targets = np.setdiff1d(np.intersect1d(model.doc_numbers, doc_numbers), segment["deleted"])
+        if len(targets) == 0:
+            continue
+        doc_ids = np.flatnonzero(np.isin(model.doc_numbers, targets))
+        terms = list(model.terms)
+        term_ids, counts = np.unique(__term_ids(model)[np.isin(model.doc_ids, doc_ids)], return_counts=True)
+        for term_id, count in zip(term_ids.tolist(), counts.tolist()):
+            manifest["df"][terms[term_id]] -= count
+            if manifest["df"][terms[term_id]] == 0:
+                del manifest["df"][terms[term_id]]
+        segment["deleted"] = sorted(segment["deleted"] + targets.tolist())
+        deleted += len(targets)
+    manifest["documents"] -= deleted
+    return deleted
+
+
+def __write_segment(index_path: str, manifest: Dict, inverted_list: Dict[str, Dict[int, int]], max_freq_in_document: Dict[int, int]) -> Dict:
+    """
+    Write a segment with the term frequencies of its documents. The IDF is not stored, since
+    it changes with every update of the index (see `load`).
+    """
+    name = f"segment-{manifest['next_segment']:06d}"
+    manifest["next_segment"] += 1
+    documents = sorted(max_freq_in_document.keys())
+    doc_ids = {doc: doc_id for doc_id, doc in enumerate(documents)}
+    with parsers.model.ModelWriter(os.path.join(index_path, name), documents,
+                                   [max_freq_in_document[doc] for doc in documents]) as writer:
+        for term in sorted(inverted_list.keys()):
+            doc_num = sorted(inverted_list[term])
+            writer.add(term, 1.0, [doc_ids[doc] for doc in doc_num],
+                       [inverted_list[term][doc] for doc in doc_num])
+    return {"name": name, "deleted": []}
+
+
+@utils.instrumentation.timed
+def add_documents(index_path: str, input_paths: List[str], steemer: bool = False, workers: int = 1, merge_threshold: int = MERGE_THRESHOLD) -> Optional[threading.Thread]:
+    """
+    Add the documents of one or more XML files to an index as a new segment, creating the
+    index if it does not exist yet.
+
+    A document already in the index (same RECORDNUM) is replaced: its older copy is
+    tombstoned and no longer retrieved. Nothing else is rewritten, so the cost of an update
+    depends on the size of the new documents only.
+
+    Args:
+    - index_path (str): the path to the index directory
+    - input_paths (List[str]): the paths to the XML files with the new documents
+    - workers (int): the number of processes used to parse the files
+    - merge_threshold (int): when the index has more segments than this, they are merged in
+      the background (see `merge_segments_in_background`). 0 never merges
+
+    Returns:
+    - Optional[threading.Thread]: the background merge, when one was started
+    """
+    inverted_list, max_freq_in_document = parsers.inverted_list.build(input_paths, steemer, workers)
+    if not max_freq_in_document:
+        return None
+    documents = sorted(max_freq_in_document.keys())
+
+    with __lock:
+        manifest = __read_manifest(index_path)
+        replaced = __tombstone(index_path, manifest, documents)
+        manifest["segments"].append(__write_segment(index_path, manifest, inverted_list, max_freq_in_document))
+        for term, frequencies in inverted_list.items():
+            manifest["df"][term] = manifest["df"].get(term, 0) + len(frequencies)
+        manifest["documents"] += len(documents)
+        __write_manifest(index_path, manifest)
+        n_segments = len(manifest["segments"])
+    logging.info("SEGMENTS - Added %d documents (%d replaced) to %s, which has %d segments",
+                 len(documents), replaced, index_path, n_segments)
+
+    if 0 < merge_threshold < n_segments:
+        return merge_segments_in_background(index_path)
+    return None
+
+
+@utils.instrumentation.timed
+def delete_documents(index_path: str, doc_numbers: Iterable[int]) -> int:
+    """
+    Tombstone documents of an index. Their postings stay in the segments until the next
+    merge, but they are no longer retrieved nor counted in the IDF.
+
+    Args:
+    - index_path (str): the path to the index directory
+    - doc_numbers (Iterable[int]): the RECORDNUMs of the documents to delete
+
+    Returns:
+    - int: the number of documents deleted
+    """
+    with __lock:
+        manifest = __read_manifest(index_path)
+        deleted = __tombstone(index_path, manifest, doc_numbers)
+        __write_manifest(index_path, manifest)
+    logging.info("SEGMENTS - Deleted %d documents from %s", deleted, index_path)
+    return deleted
+
+
+@utils.instrumentation.timed
+def merge_segments(index_path: str) -> None:
+    """
+    Merge every segment of an index into one, dropping the tombstoned documents.
+
+    The segments are read from a snapshot of the manifest, so documents can still be added
+    and deleted while the merge runs: segments added meanwhile are kept as they are, and
+    deletions made meanwhile are carried over to the merged segment. When every document of
+    the segments merged was deleted, they are dropped and no segment is written.
+
+    Args:
+    - index_path (str): the path to the index directory
+
+    Returns:
+    - None
+    """
+    with __lock:
+        manifest = __read_manifest(index_path)
+        snapshot = manifest["segments"]
+        if not snapshot or (len(snapshot) == 1 and not snapshot[0]["deleted"]):
+            return
+        name = f"segment-{manifest['next_segment']:06d}"
+        manifest["next_segment"] += 1
+        __write_manifest(index_path, manifest)
+    logging.info("SEGMENTS - Merging %d segments of %s", len(snapshot), index_path)
+
+    terms, doc_numbers, frequencies, max_frequencies = [], [], [], {}
+    for segment in snapshot:
+        model = parsers.model.load(os.path.join(index_path, segment["name"]))
+        live_documents = ~np.isin(model.doc_numbers, segment["deleted"])
+        live = live_documents[model.doc_ids]
+        terms.append(np.asarray(list(model.terms), dtype=object)[__term_ids(model)[live]])
+        doc_numbers.append(np.asarray(model.doc_numbers)[model.doc_ids[live]])
+        frequencies.append(model.frequencies[live])
+        max_frequencies.update(zip(np.asarray(model.doc_numbers)[live_documents].tolist(),
+                                   np.asarray(model.max_frequencies)[live_documents].tolist()))
+    terms, doc_numbers, frequencies = np.concatenate(terms), np.concatenate(doc_numbers), np.concatenate(frequencies)
+    order = np.lexsort((doc_numbers, terms))
+    terms, doc_numbers, frequencies = terms[order], doc_numbers[order], frequencies[order]
+
+    documents = np.unique(doc_numbers)
+    # When every document merged was deleted, the merged segments are dropped and none is written.
+    if len(documents) > 0:
+        doc_ids = np.searchsorted(documents, doc_numbers)
+        bounds = np.flatnonzero(np.r_[True, terms[1:] != terms[:-1], True])
+        segment_path = os.path.join(index_path, name)
+        try:
+            with parsers.model.ModelWriter(segment_path, documents.tolist(),
+                                           [max_frequencies[doc] for doc in documents.tolist()]) as writer:
+                for start, end in zip(bounds[:-1], bounds[1:]):
+                    writer.add(terms[start], 1.0, doc_ids[start:end], frequencies[start:end])
+        except Exception:
+            # The new segment is not in the manifest yet, so whatever was written of it is dropped.
+            logging.exception("SEGMENTS - Failed to merge the segments of %s into %s", index_path, name)
+            shutil.rmtree(segment_path + ".tmp", ignore_errors=True)
+            shutil.rmtree(segment_path, ignore_errors=True)
+            raise
+
+    merged = {segment["name"]: set(segment["deleted"]) for segment in snapshot}
+    with __lock:
+        manifest = __read_manifest(index_path)
+        deleted_meanwhile = set()
+        for segment in manifest["segments"]:
+            if segment["name"] in merged:
+                deleted_meanwhile.update(set(segment["deleted"]) - merged[segment["name"]])
+        manifest["segments"] = [
+            segment for segment in manifest["segments"] if segment["name"] not in merged
+        ]
+        if len(documents) > 0:
+            manifest["segments"].insert(0, {"name": name, "deleted": sorted(deleted_meanwhile & set(documents.tolist()))})
+        __write_manifest(index_path, manifest)
+        for segment_name in merged:
+            shutil.rmtree(os.path.join(index_path, segment_name), ignore_errors=True)
+    if len(documents) > 0:
+        logging.info("SEGMENTS - Merged %d documents into %s", len(documents), name)
+    else:
+        logging.info("SEGMENTS - Dropped %d segments of %s whose documents were all deleted", len(merged), index_path)
+
+
+def merge_segments_in_background(index_path: str) -> threading.Thread:
+    """
+    Run `merge_segments` in a thread. The thread is not a daemon, so the program waits for
+    the merge to finish before exiting.
+    """
+    thread = threading.Thread(target=merge_segments, args=(index_path,), name=f"merge {index_path}")
+    thread.start()
+    return thread
+
+
+@utils.instrumentation.timed
+def load(index_path: str) -> List[parsers.model.Model]:
+    """
+    Open every segment of an index as a model ready to be searched.
+
+    The IDF of each term is computed from the live document frequencies of the manifest,
+    log(N / df), and the document norms and term upper bounds of each segment are computed
+    from it here, at open time. The postings stay compressed, and their TF-IDF weights are
+    computed with this IDF when they are decoded. The weights of tombstoned documents are
+    zero and their `live` flag is False.
+
+    Args:
+    - index_path (str): the path to the index directory
+
+    Returns:
+    - List[Model]: one model per segment, sharing the same IDF
+    """
+    with __lock:
+        manifest = __read_manifest(index_path)
+        segments = [
+            (parsers.model.load(os.path.join(index_path, segment["name"])), segment["deleted"])
+            for segment in manifest["segments"]
+        ]
+    total_documents = manifest["documents"]
+
+    models = []
+    for segment, deleted in segments:
+        idf = np.array([
+            math.log(total_documents / manifest["df"][term]) if term in manifest["df"] else 0.0
+            for term in segment.terms
+        ], dtype=parsers.model.FLOAT_DTYPE)
+        live = ~np.isin(segment.doc_numbers, deleted)
+        model = parsers.model.Model(
+            terms=segment.terms,
+            offsets=segment.offsets,
+            block_starts=segment.block_starts,
+            block_last=segment.block_last,
+            postings_bytes=segment.postings_bytes,
+            idf=idf,
+            # An infinite largest frequency gives every posting of a deleted document a weight of zero.
+            max_frequencies=np.where(live, segment.max_frequencies, np.inf),
+            upper_bounds=None,
+            doc_numbers=segment.doc_numbers,
+            norms=None,
+            live=live,
+            version=manifest.get("version"),
+            block_size=segment.block_size
+        )
+        weights = model.weights
+        model.norms = np.sqrt(np.bincount(model.doc_ids, weights=weights.astype(parsers.model.FLOAT_DTYPE) ** 2,
+                                          minlength=model.n_documents))
+        model.upper_bounds = parsers.model.term_upper_bounds(model.offsets, model.doc_ids, weights, model.norms)
+        models.append(model)
+    logging.info("SEGMENTS - Opened %d segments of %s with %d live documents",
+                 len(models), index_path, total_documents)
+    return models
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+import parsers.model
+import parsers.search
+import parsers.segments
+import parsers.shards
+import utils
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error"}
+
+
+class SearchServer:
+    """
+    A long-running query service over HTTP, which opens every model once and keeps it
+    in memory between requests.
+
+    Endpoints:
+    - GET /search?q=<text>[&k=<top k>][&variant=<name>]: ranks the documents for one query.
+    - POST /search: ranks the documents for many queries. The body is a JSON object with
+      "queries" (query number -> text) and optionally "k" and "variant".
+    - GET /stats: the number of requests served, their latency percentiles and the hit
+      rate of the result cache of each variant.
+
+    Every response is a JSON object with a "latency_ms" field, the time spent serving the
+    request, which is also sent in the X-Response-Time header.
+
+    The results are cached per variant (see `parsers.search.ResultCache`). When the indexer
+    writes a new model, or the incremental index is updated, the server reopens it on the
+    next request and the cached results of the previous version are dropped.
+
+    Example:
+    >>> server = SearchServer({"NOSTEEMER": ("./data/parsed/modelo-NOSTEEMER", False)})
+    >>> server.run("127.0.0.1", 8000)
+    $ curl "http://127.0.0.1:8000/search?q=cystic+fibrosis&k=5"
+    """
+
+    def __init__(self, variants: Dict[str, Tuple[str, bool]], top_k: int = 10, max_score: bool = False, window: int = 10000, cache_entries: int = 10000):
+        """
+        Args:
+        - variants (Dict[str, Tuple[str, bool]]): the model path and whether it is stemmed, by
+          variant name. The first variant is used when a request names none
+        - top_k (int): how many documents to return when a request does not say
+        - max_score (bool): whether to skip documents that cannot enter the top k
+        - window (int): how many of the latest latencies are kept for the statistics
+        - cache_entries (int): how many queries are cached per variant. 0 disables the cache
+        """
+        self.model_paths = {}
+        self.model_stamps = {}
+        self.models = {}
+        self.normalizers = {}
+        self.caches = {}
+        for name, (model_path, steemer) in variants.items():
+            self.model_paths[name] = model_path.strip()
+            self.normalizers[name] = utils.get_normalizer(stopwords=True, steemer=steemer)
+            self.caches[name] = parsers.search.ResultCache(cache_entries) if cache_entries > 0 else None
+            self.__refresh(name)
+        self.default_variant = next(iter(variants))
+        self.top_k = top_k
+        self.max_score = max_score
+        self.requests = 0
+        self.latencies = deque(maxlen=window)
+
+    def __refresh(self, variant: str) -> None:
+        """
+        Reopen the model of a variant if it was rewritten since it was opened. The model
+        directory and the manifest of an index are replaced as a whole when they are
+        written, so a new modification time of the file holding the version is enough.
+        The shards of a sharded model are all opened in this process, and their results
+        merged by score (see `parsers.search.open_model`).
+        """
+        model_path = self.model_paths[variant]
+        if parsers.segments.is_index(model_path):
+            version_path = os.path.join(model_path, parsers.segments.MANIFEST_FILE)
+        elif parsers.shards.is_index(model_path):
+            version_path = os.path.join(model_path, parsers.shards.MANIFEST_FILE)
+        else:
+            version_path = os.path.join(model_path, parsers.model.META_FILE)
+        stamp = os.stat(version_path).st_mtime_ns
+        if self.model_stamps.get(variant) != stamp:
+            self.models[variant] = parsers.search.open_model(model_path)
+            self.model_stamps[variant] = stamp
+
+    def search(self, text: str, top_k: int, variant: str) -> List[Tuple[int, float]]:
+        self.__refresh(variant)
+        query = self.normalizers[variant].normalize(text)
+        return parsers.search.search(query, self.models[variant], top_k, self.max_score, self.caches[variant])
+
+    def search_batch(self, texts: Dict[str, str], top_k: int, variant: str) -> Dict[str, List[Tuple[int, float]]]:
+        """
+        Rank many queries, scoring the ones missing from the cache together.
+        """
+        self.__refresh(variant)
+        models, cache = self.models[variant], self.caches[variant]
+        normalizer = self.normalizers[variant]
+        queries = {i: normalizer.normalize(text) for i, text in texts.items()}
+        if cache is None:
+            return dict(parsers.search.search_batch(queries, models, top_k))
+
+        version = models[0].version if models else None
+        results, missing = {}, {}
+        for i, query in queries.items():
+            results[i] = cache.get(cache.key(query, top_k, False), version)
+            if results[i] is None:
+                missing[i] = query
+        for i, query_results in parsers.search.search_batch(missing, models, top_k):
+            cache.put(cache.key(missing[i], top_k, False), version, query_results)
+            results[i] = query_results
+        return results
+
+    def stats(self) -> Dict:
+        stats = {"requests": self.requests}
+        latencies = np.asarray(self.latencies)
+        if len(latencies) > 0:
+            stats.update({
+                "mean_ms": float(latencies.mean()),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+            })
+        stats["cache"] = {
+            variant: cache.stats() for variant, cache in self.caches.items() if cache is not None
+        }
+        return stats
+
+    def handle(self, method: str, target: str, body: bytes) -> Tuple[int, Dict]:
+        """
+        Serve one request, returning the HTTP status and the JSON payload.
+        """
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path == "/stats":
+            return 200, self.stats()
+        if url.path != "/search":
+            return 404, {"error": f"Unknown path {url.path}"}
+        try:
+            if method == "GET":
+                payload = params
+            elif method == "POST":
+                payload = json.loads(body or b"{}")
+            else:
+                return 405, {"error": f"Method {method} not allowed"}
+            top_k = int(payload.get("k", self.top_k))
+            variant = payload.get("variant", self.default_variant)
+            if variant not in self.models:
+                return 400, {"error": f"Unknown variant {variant}, expected one of {list(self.models)}"}
+            if method == "GET":
+                if "q" not in payload:
+                    return 400, {"error": "Missing query parameter q"}
+                return 200, {"query": payload["q"], "results": self.search(payload["q"], top_k, variant)}
+            return 200, {"results": self.search_batch(payload["queries"], top_k, variant)}
+        except (KeyError, TypeError, ValueError, AttributeError) as error:
+            return 400, {"error": f"Invalid request: {error!r}"}
+
+    async def __serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Serve the requests of one HTTP/1.1 connection, which is kept open until the client
+        closes it or sends "Connection: close". A request that fails unexpectedly gets a 500
+        response, and the connection keeps being served.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                start = time.perf_counter()
+                try:
+                    status, payload = self.handle(method, target, body)
+                except Exception as error:
+                    # A request that fails, say on a model being rewritten, must not stop the server.
+                    logging.exception("SEARCH SERVER - Failed to serve %s %s", method, target)
+                    status, payload = 500, {"error": f"Internal error: {error!r}"}
+                latency = (time.perf_counter() - start) * 1000
+                self.requests += 1
+                self.latencies.append(latency)
+                payload["latency_ms"] = latency
+                logging.info("SEARCH SERVER - %s %s %d in %.3f ms", method, target, status, latency)
+
+                content = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(content)}\r\n"
+                    f"X-Response-Time: {latency:.3f}ms\r\n\r\n".encode("latin-1") + content
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as error:
+            logging.warning("SEARCH SERVER - Dropping connection: %r", error)
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.__serve_connection, host, port)
+        logging.info("SEARCH SERVER - Listening on http://%s:%d with variants %s",
+                     host, port, ", ".join(self.models))
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host: str = "127.0.0.1", port: int = 8000) -> None:
+        """
+        Serve until interrupted.
+        """
+        try:
+            asyncio.run(self.serve(host, port))
+        except KeyboardInterrupt:
+            logging.info("SEARCH SERVER - Stopped after %d requests", self.requests)
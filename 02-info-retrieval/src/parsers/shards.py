@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import parsers.compression
+import parsers.model
+import parsers.vocabulary
+import utils.instrumentation
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+MANIFEST_FILE = "shards.json"
+DF_FILE = "df.bin"
+PARTITIONS = ("range", "hash")
+
+# Knuth's multiplicative hash, so that record numbers with a common pattern (all even, say)
+# are still spread over every shard.
+__HASH_MULTIPLIER = 2654435761
+
+
+def __manifest_path(index_path: str) -> str:
+    return os.path.join(index_path, MANIFEST_FILE)
+
+
+def is_index(path: str) -> bool:
+    return os.path.isfile(__manifest_path(path))
+
+
+def __read_manifest(index_path: str) -> Dict:
+    with open(__manifest_path(index_path), "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def partition(doc_numbers: np.ndarray, n_shards: int, method: str = "range") -> np.ndarray:
+    """
+    The shard of each document.
+
+    With "range", the documents sorted by record number are split in `n_shards` ranges with
+    the same number of documents (give or take one). With "hash", a document goes to the shard
+    given by a hash of its record number, so new documents are spread over every shard
+    instead of growing the last one.
+
+    Example:
+    >>> partition([1, 2, 3, 4, 5], 2).tolist()
+    [0, 0, 0, 1, 1]
+    """
+    if method not in PARTITIONS:
+        raise ValueError(f"Unknown partition {method}, expected one of {PARTITIONS}")
+    doc_numbers = np.asarray(doc_numbers, dtype=np.uint64)
+    if method == "hash":
+        return ((doc_numbers * np.uint64(__HASH_MULTIPLIER)) & np.uint64(0xFFFFFFFF)) % np.uint64(n_shards)
+    ranks = np.argsort(np.argsort(doc_numbers, kind="stable"), kind="stable")
+    return ranks * n_shards // max(len(doc_numbers), 1)
+
+
+class ShardWriter:
+    """
+    Writes a document-partitioned model: the documents are split in shards (see `partition`),
+    each one a model directory of its own (see `parsers.model.ModelWriter`) with the postings,
+    norms and upper bounds of its documents only, so a shard can be searched on its own by the
+    node that holds it.
+
+    The IDF stored in every shard is computed over the whole collection, so a document gets
+    the same similarity as in a single model, and the top k lists of the shards can be merged
+    by score. The document frequency of every term in the whole collection is also saved at
+    the root of the model, with the manifest of the shards.
+
+    It takes the same arguments as `parsers.model.ModelWriter`, and the whole model replaces
+    `path` on close.
+
+    Example:
+    >>> with ShardWriter("./data/parsed/modelo", [1, 2, 3], [4, 1, 2], n_shards=2) as writer:
+    ...     writer.add("FIBROSIS", 0.4, [0, 2], [2, 1])
+    """
+
+    def __init__(self, path: str, doc_numbers: List[int], max_frequencies: List[int], n_shards: int,
+                 method: str = "range", block_size: int = parsers.compression.BLOCK_SIZE):
+        self.final_path = os.path.normpath(path)
+        self.path = self.final_path + ".tmp"
+        self.method = method
+        doc_numbers = np.asarray(doc_numbers, dtype=parsers.model.DOC_ID_DTYPE)
+        max_frequencies = np.asarray(max_frequencies, dtype=parsers.model.FREQUENCY_DTYPE)
+        # Shards left without documents are dropped, and the others numbered again.
+        _, self.shards = np.unique(partition(doc_numbers, n_shards, method), return_inverse=True)
+        n_shards = int(self.shards.max()) + 1 if len(doc_numbers) else 0
+        self.local_ids = np.zeros(len(doc_numbers), dtype=np.int64)
+        self.names, self.writers, self.shard_doc_numbers = [], [], []
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        for shard in range(n_shards):
+            members = np.flatnonzero(self.shards == shard)
+            self.local_ids[members] = np.arange(len(members))
+            self.names.append(f"shard-{shard:03d}")
+            self.shard_doc_numbers.append(doc_numbers[members])
+            self.writers.append(parsers.model.ModelWriter(
+                os.path.join(self.path, self.names[-1]), doc_numbers[members], max_frequencies[members], block_size))
+        self.terms = []
+        self.df = []
+
+    def add(self, term: str, idf: float, doc_ids: List[int], frequencies: List[int]) -> None:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        frequencies = np.asarray(frequencies, dtype=np.int64)
+        shards = self.shards[doc_ids]
+        # A stable sort keeps the documents of each shard in increasing order.
+        order = np.argsort(shards, kind="stable")
+        bounds = np.searchsorted(shards[order], np.arange(len(self.writers) + 1))
+        for shard in np.flatnonzero(np.diff(bounds)).tolist():
+            selected = order[bounds[shard]:bounds[shard + 1]]
+            self.writers[shard].add(term, idf, self.local_ids[doc_ids[selected]], frequencies[selected])
+        self.terms.append(term)
+        self.df.append(len(doc_ids))
+
+    def close(self) -> None:
+        for writer in self.writers:
+            writer.close()
+        parsers.vocabulary.write(self.path, self.terms)
+        np.asarray(self.df, dtype=np.int64).tofile(os.path.join(self.path, DF_FILE))
+        with open(os.path.join(self.path, MANIFEST_FILE), "w", encoding="utf-8") as file:
+            json.dump({
+                "partition": self.method,
+                "documents": len(self.shards),
+                "terms": len(self.terms),
+                "shards": [
+                    {"name": name, "documents": len(doc_numbers),
+                     "first": int(doc_numbers.min()), "last": int(doc_numbers.max())}
+                    for name, doc_numbers in zip(self.names, self.shard_doc_numbers)
+                ],
+                "version": uuid.uuid4().hex
+            }, file)
+        parsers.model.replace_directory(self.path, self.final_path)
+        logging.info("SHARDS - Saved %d documents in %d shards (%s partition) in %s",
+                     len(self.shards), len(self.writers), self.method, self.final_path)
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def shard_paths(index_path: str) -> List[str]:
+    """
+    The model directory of every shard of a sharded model.
+    """
+    return [os.path.join(index_path, shard["name"]) for shard in __read_manifest(index_path)["shards"]]
+
+
+def statistics(index_path: str) -> Tuple[parsers.vocabulary.Vocabulary, np.ndarray, int]:
+    """
+    The collection-wide statistics of a sharded model.
+
+    Returns:
+    - Tuple[Vocabulary, np.ndarray, int]: the terms of all the shards, the document frequency
+      of each term (by term id) and the number of documents
+    """
+    manifest = __read_manifest(index_path)
+    df = np.fromfile(os.path.join(index_path, DF_FILE), dtype=np.int64)
+    return parsers.vocabulary.load(index_path), df, manifest["documents"]
+
+
+@utils.instrumentation.timed
+def load(index_path: str) -> List[parsers.model.Model]:
+    """
+    Open every shard of a sharded model in this process, to be searched like the segments of
+    an incremental index. The shards share the IDF of the whole collection, so their
+    similarities can be ranked together.
+
+    Args:
+    - index_path (str): the path to the sharded model directory
+
+    Returns:
+    - List[Model]: one memory-mapped model per shard
+    """
+    models = [parsers.model.load(path) for path in shard_paths(index_path)]
+    logging.info("SHARDS - Opened %d shards of %s with %d documents",
+                 len(models), index_path, sum(model.n_documents for model in models))
+    return models
@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import logging
+import os
+import shutil
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+import parsers.reader
+import utils
+import utils.instrumentation
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# Rough sizes of the Python objects of the partial inverted list, measured on the CFC
+# collection, used to tell when it reaches the memory budget.
+POSTING_BYTES = 64
+TERM_BYTES = 100
+
+
+def __write_run(run_path: str, inverted_list: Dict[str, Dict[int, int]]) -> None:
+    """
+    Save a partial inverted list sorted by term, one term per line followed by the
+    record numbers and frequencies of its postings, sorted by record number.
+    """
+    with open(run_path, "w", encoding="utf-8") as file:
+        for term in sorted(inverted_list):
+            postings = inverted_list[term]
+            file.write(term + "\t" + " ".join(f"{doc} {postings[doc]}" for doc in sorted(postings)) + "\n")
+    logging.info("SPIMI - Saved run %s with %d terms", run_path, len(inverted_list))
+
+
+def __read_run(run_path: str) -> Iterator[Tuple[str, List[int]]]:
+    with open(run_path, "r", encoding="utf-8") as file:
+        for line in file:
+            term, postings = line.rstrip("\n").split("\t")
+            yield term, list(map(int, postings.split()))
+
+
+def __write_file_runs(input_path: str, run_prefix: str, steemer: bool, memory_budget: int) -> Tuple[List[str], Dict[int, int]]:
+    """
+    Index the documents of an XML file in memory, flushing the partial inverted list to a
+    new run file whenever its estimated size reaches `memory_budget` bytes.
+    """
+    logging.info("SPIMI - Reading file %s", input_path)
+    normalizer = utils.get_normalizer(stopwords=True, steemer=steemer)
+    inverted_list = defaultdict(dict)
+    max_freq_in_document = {}
+    run_paths = []
+    n_postings = n_documents = n_tokens = 0
+    for record in parsers.reader.read_records(input_path):
+        terms = Counter(normalizer.normalize(record.text))
+        if not terms:
+            continue
+        n_documents += 1
+        n_tokens += sum(terms.values())
+        max_freq_in_document[record.record_num] = max(terms.values())
+        for term, frequency in terms.items():
+            inverted_list[term][record.record_num] = frequency
+        n_postings += len(terms)
+        if n_postings * POSTING_BYTES + len(inverted_list) * TERM_BYTES >= memory_budget:
+            run_paths.append(f"{run_prefix}-{len(run_paths):05d}.run")
+            __write_run(run_paths[-1], inverted_list)
+            inverted_list = defaultdict(dict)
+            n_postings = 0
+    if inverted_list:
+        run_paths.append(f"{run_prefix}-{len(run_paths):05d}.run")
+        __write_run(run_paths[-1], inverted_list)
+
+    utils.instrumentation.count("documents parsed", n_documents)
+    utils.instrumentation.count("tokens", n_tokens)
+    utils.instrumentation.count("runs written", len(run_paths))
+    return run_paths, max_freq_in_document
+
+
+@utils.instrumentation.timed
+def write_runs(input_paths: List[str], runs_path: str, steemer: bool = False, memory_budget: int = 256, workers: int = 1) -> Tuple[List[str], Dict[int, int]]:
+    """
+    Single-pass in-memory indexing: read the documents once, building a partial inverted
+    list in memory until it reaches the memory budget, then save it sorted by term as a run
+    file and start a new one. Only the largest term frequency of each document is kept for
+    the whole collection.
+
+    Args:
+    - input_paths (List[str]): the paths to the XML files with the documents
+    - runs_path (str): the directory where the run files are written
+    - memory_budget (int): how many megabytes the partial inverted lists may take, shared
+      by the workers
+    - workers (int): the number of processes that read the files, each one writing its own runs
+
+    Returns:
+    - Tuple[List[str], Dict[int, int]]: the paths to the run files and the maximum frequency in each document
+    """
+    os.makedirs(runs_path, exist_ok=True)
+    budget = memory_budget * 1024 * 1024 // max(workers, 1)
+    arguments = [
+        (input_path.strip(), os.path.join(runs_path, f"{i:05d}"), steemer, budget)
+        for i, input_path in enumerate(input_paths)
+    ]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = []
+            for result, measures in executor.map(utils.instrumentation.capture,
+                                                 [__write_file_runs] * len(arguments), *zip(*arguments)):
+                utils.instrumentation.merge(measures)
+                results.append(result)
+    else:
+        results = [__write_file_runs(*file_arguments) for file_arguments in arguments]
+
+    run_paths, max_freq_in_document = [], {}
+    for file_run_paths, file_max_freq_in_document in results:
+        run_paths.extend(file_run_paths)
+        max_freq_in_document.update(file_max_freq_in_document)
+    logging.info("SPIMI - Wrote %d runs for %d documents", len(run_paths), len(max_freq_in_document))
+    return run_paths, max_freq_in_document
+
+
+def merge_runs(run_paths: List[str]) -> Iterator[Tuple[str, List[Tuple[int, int]]]]:
+    """
+    K-way merge of run files: yield every term in sorted order with its postings from all
+    the runs, as (record number, frequency) pairs sorted by record number. Only one line
+    of each run is held in memory at a time.
+    """
+    runs = heapq.merge(*(__read_run(run_path) for run_path in run_paths), key=lambda line: line[0])
+    for term, lines in itertools.groupby(runs, key=lambda line: line[0]):
+        # A record found in more than one run keeps the frequency of the last one, as with
+        # `parsers.inverted_list.build`, and the records are sorted, since the runs of
+        # different files may hold them in any order.
+        postings = dict(pair for _, numbers in lines for pair in zip(numbers[::2], numbers[1::2]))
+        yield term, sorted(postings.items())
+
+
+def remove_runs(runs_path: str) -> None:
+    shutil.rmtree(runs_path, ignore_errors=True)
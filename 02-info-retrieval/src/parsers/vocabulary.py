@@ -0,0 +1,130 @@
+import logging
+import os
+import zlib
+from collections.abc import Mapping
+from typing import Iterator, List
+
+import numpy as np
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+TERMS_FILE = "terms.bin"
+OFFSETS_FILE = "term_offsets.bin"
+TABLE_FILE = "term_table.bin"
+
+OFFSET_DTYPE = np.int64
+TERM_ID_DTYPE = np.int32
+EMPTY = -1
+
+
+def __map(path: str, dtype: np.dtype) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r").view(np.ndarray)
+
+
+class Vocabulary(Mapping):
+    """
+    The terms of a model and their dense integer ids, as a read-only mapping from term to id.
+
+    The terms are held as a single UTF-8 buffer, the term with id `t` being
+    `data[offsets[t]:offsets[t + 1]]`, and they are found through an open addressing hash
+    table of term ids indexed by the CRC-32 of the term. The three arrays are memory-mapped,
+    so opening a model does not read its terms, and a term takes a few bytes of its own plus
+    two arrays entries instead of a Python string and a dictionary entry.
+
+    Example:
+    >>> vocabulary = load("./data/parsed/modelo-NOSTEEMER")
+    >>> vocabulary.term(vocabulary["FIBROSIS"])
+    'FIBROSIS'
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray, table: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+        self.table = table
+        self.mask = len(table) - 1
+        # Memoryviews of the same buffers, which index to plain ints and bytes much faster than numpy.
+        self._data = memoryview(data)
+        self._offsets = memoryview(offsets)
+        self._table = memoryview(table)
+
+    def term(self, term_id: int) -> str:
+        return self.data[self.offsets[term_id]:self.offsets[term_id + 1]].tobytes().decode("utf-8")
+
+    def get(self, term: str, default: int = None) -> int:
+        key = term.encode("utf-8")
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            term_id = self._table[slot]
+            if term_id == EMPTY:
+                return default
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            if end - start == len(key) and self._data[start:end] == key:
+                return term_id
+            slot = (slot + 1) & self.mask
+
+    def __getitem__(self, term: str) -> int:
+        term_id = self.get(term)
+        if term_id is None:
+            raise KeyError(term)
+        return term_id
+
+    def __contains__(self, term: object) -> bool:
+        return isinstance(term, str) and self.get(term) is not None
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        """
+        The terms in the order of their ids.
+        """
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield data[start:end].decode("utf-8")
+
+
+def write(path: str, terms: List[str]) -> None:
+    """
+    Save the terms of a model, the term with id `t` being `terms[t]`, with their hash table,
+    which has at least twice as many slots as there are terms.
+
+    Args:
+    - path (str): the model directory
+    - terms (List[str]): the distinct terms, in the order of their ids
+    """
+    keys = [term.encode("utf-8") for term in terms]
+    offsets = np.zeros(len(keys) + 1, dtype=OFFSET_DTYPE)
+    np.cumsum([len(key) for key in keys], out=offsets[1:])
+    size = 1 << max(2 * len(keys) - 1, 1).bit_length()
+    table = np.full(size, EMPTY, dtype=TERM_ID_DTYPE)
+    mask = size - 1
+    for term_id, key in enumerate(keys):
+        slot = zlib.crc32(key) & mask
+        while table[slot] != EMPTY:
+            slot = (slot + 1) & mask
+        table[slot] = term_id
+
+    with open(os.path.join(path, TERMS_FILE), "wb") as file:
+        file.write(b"".join(keys))
+    offsets.tofile(os.path.join(path, OFFSETS_FILE))
+    table.tofile(os.path.join(path, TABLE_FILE))
+
+
+def load(path: str) -> Vocabulary:
+    """
+    Open the terms of a model directory saved by `write`.
+
+    Args:
+    - path (str): the model directory
+
+    Returns:
+    - Vocabulary: the memory-mapped vocabulary
+    """
+    return Vocabulary(
+        data=__map(os.path.join(path, TERMS_FILE), np.uint8),
+        offsets=__map(os.path.join(path, OFFSETS_FILE), OFFSET_DTYPE),
+        table=__map(os.path.join(path, TABLE_FILE), TERM_ID_DTYPE)
+    )
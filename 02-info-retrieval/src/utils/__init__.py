@@ -1,10 +1,14 @@
-from typing import List, Tuple
+from functools import lru_cache
+from typing import FrozenSet, List, Tuple
 import unicodedata
+import os
 import re
 import csv
 
 from nltk.stem.porter import PorterStemmer
 
+STOPWORDS_PATH = os.path.join(os.path.dirname(__file__), "stopwords.txt")
+
 
 def strip_accents(s: str) -> str:
     """
@@ -49,24 +53,25 @@ def strip_special_characters(s: str) -> str:
     return re.sub(r"[^a-zA-Z]+", " ", s)
 
 
-def get_stopwords():
+@lru_cache(maxsize=None)
+def get_stopwords() -> FrozenSet[str]:
     """
     Retrieve a set of stopwords from a file.
 
     Returns:
-        str: A string containing a list of stopwords separated by newlines.
+        FrozenSet[str]: The set of stopwords, in lowercase.
 
     Example:
         >>> stopwords = get_stopwords()
         >>> "the" in stopwords
         True
 
-    The function retrieves a set of stopwords from a file located at "./utils/stopwords.txt" with the UTF-8 encoding. The file should contain one stopword per line, and no leading or trailing spaces.
+    The function retrieves a set of stopwords from the file "stopwords.txt" next to this module, with the UTF-8 encoding. The file should contain one stopword per line, and no leading or trailing spaces.
 
-    Returns the content of the file as a string.
+    The file is read only once; later calls return the same set.
     """
-    with open("./utils/stopwords.txt", "r", encoding="utf-8") as file:
-        return file.read()
+    with open(STOPWORDS_PATH, "r", encoding="utf-8") as file:
+        return frozenset(line.strip() for line in file if line.strip())
 
 
 def remove_stopwords(s: str) -> str:
@@ -94,6 +99,64 @@ def remove_stopwords(s: str) -> str:
     return s
 
 
+class Normalizer:
+    """
+    A reusable text normalization pipeline.
+
+    The stopwords are loaded once into a set, the token pattern is compiled once, and a single
+    Porter stemmer is shared by every call. Stemming is applied to each term and memoized in a
+    bounded LRU cache: the vocabulary is Zipfian, so a few thousand entries answer almost every call.
+
+    Args:
+        stopwords (bool): Whether to remove stopwords from the text. Defaults to True.
+        steemer (bool): Whether to apply the Porter stemmer. Defaults to False.
+        cache_size (int): How many stemmed terms are kept in the cache. Defaults to 8192.
+
+    Example:
+        >>> normalizer = Normalizer()
+        >>> normalizer.normalize("This is an example text with some stopwords.")
+        ['TEXT', 'STOPWORDS']
+    """
+    TOKEN_PATTERN = re.compile(r"[A-Z]+")
+
+    def __init__(self, stopwords: bool = True, steemer: bool = False, cache_size: int = 8192):
+        self.stopwords = frozenset(word.upper() for word in get_stopwords()) if stopwords else frozenset()
+        self.steemer = steemer
+        self.stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=cache_size)(self.__stem)
+
+    def __stem(self, term: str) -> str:
+        return self.stemmer.stem(term).upper()
+
+    def normalize(self, s: str) -> List[str]:
+        """
+        Normalize a text string into a list of terms.
+
+        Args:
+            s (str): The input text string to normalize.
+
+        Returns:
+            List[str]: The terms of the text, in uppercase and without accents or stopwords.
+
+        The text is converted to uppercase and split into runs of the letters A to Z, which drops special characters and
+        accented letters alike, and the stopwords are removed. When stemming, each remaining term is replaced by its
+        uppercased Porter stem. Stemming is not idempotent, so a text should only be normalized with the stemmer once.
+        """
+        tokens = [token for token in self.TOKEN_PATTERN.findall(s.upper())
+                  if token not in self.stopwords]
+        if self.steemer:
+            tokens = [self.stem(token) for token in tokens]
+        return tokens
+
+
+@lru_cache(maxsize=None)
+def get_normalizer(stopwords: bool = True, steemer: bool = False) -> Normalizer:
+    """
+    Return the shared `Normalizer` for a combination of options, creating it on the first call.
+    """
+    return Normalizer(stopwords=stopwords, steemer=steemer)
+
+
 def normalize_text(s: str, stopwords: bool = True, steemer: bool = False) -> str:
     """
     Normalize and preprocess a text string.
@@ -108,26 +171,11 @@ def normalize_text(s: str, stopwords: bool = True, steemer: bool = False) -> str
     Example:
         >>> text = "This is an example text with some stopwords."
         >>> normalize_text(text)
-        'THIS IS EXAMPLE TEXT SOME'
+        'TEXT STOPWORDS'
 
-    The function normalizes the input text string `s` by converting all characters to uppercase, removing special characters with the `strip_special_characters` function, optionally removing stopwords with the `remove_stopwords` function if `stopwords` is True, removing accents with the `strip_accents` function, replacing newline characters with spaces, and removing extra spaces with a regular expression.
-
-    If `stopwords` is True, the function removes a predefined set of stopwords from the text using the `remove_stopwords` function.
-
-    Returns the resulting normalized string with leading and trailing spaces stripped.
+    The function joins with spaces the terms returned by the shared `Normalizer` for the given options (see `get_normalizer`).
     """
-    s = s.upper()
-    s = strip_special_characters(s)
-    if stopwords:
-        s = remove_stopwords(s)
-    s = strip_accents(s)
-    s = s.replace("\n", " ")
-    s = re.sub(r" +", " ", s)
-    s = s.strip()
-    if steemer:
-        steemer = PorterStemmer()
-        s = steemer.stem(s)
-    return s
+    return " ".join(get_normalizer(stopwords, steemer).normalize(s))
 
 
 def write_to_csv(output_path: str, fieldnames: List[str], values: List[Tuple], mode: str = "w") -> None:
@@ -0,0 +1,204 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+__lock = threading.Lock()
+__timers = {}
+__counters = {}
+__distributions = {}
+__profile = {}
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """
+    Measure the wall and CPU time of a block, adding it to the timer `name`.
+
+    Example:
+    >>> with timer("index"):
+    ...     write_model(...)
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        with __lock:
+            measures = __timers.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0})
+            measures["calls"] += 1
+            measures["wall"] += wall
+            measures["cpu"] += cpu
+            measures["max_wall"] = max(measures["max_wall"], wall)
+
+
+def timed(function: Callable) -> Callable:
+    """
+    Decorate a function so every call is measured by the timer "<module>.<function>".
+    """
+    name = f"{function.__module__}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with timer(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def count(name: str, value: int = 1) -> None:
+    with __lock:
+        __counters[name] = __counters.get(name, 0) + value
+
+
+def observe(name: str, value: float) -> None:
+    """
+    Record one value of a distribution, such as the number of documents scored by a query.
+    """
+    with __lock:
+        measures = __distributions.get(name)
+        if measures is None:
+            __distributions[name] = {"count": 1, "total": value, "min": value, "max": value}
+        else:
+            measures["count"] += 1
+            measures["total"] += value
+            measures["min"] = min(measures["min"], value)
+            measures["max"] = max(measures["max"], value)
+
+
+def snapshot() -> Dict:
+    with __lock:
+        return {
+            "timers": {name: dict(measures) for name, measures in __timers.items()},
+            "counters": dict(__counters),
+            "distributions": {name: dict(measures) for name, measures in __distributions.items()},
+        }
+
+
+def merge(other: Dict) -> None:
+    """
+    Add the measures of a snapshot, taken in another process, to the ones of this process.
+    """
+    with __lock:
+        for name, measures in other["timers"].items():
+            current = __timers.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0})
+            current["calls"] += measures["calls"]
+            current["wall"] += measures["wall"]
+            current["cpu"] += measures["cpu"]
+            current["max_wall"] = max(current["max_wall"], measures["max_wall"])
+        for name, value in other["counters"].items():
+            __counters[name] = __counters.get(name, 0) + value
+        for name, measures in other["distributions"].items():
+            current = __distributions.get(name)
+            if current is None:
+                __distributions[name] = dict(measures)
+            else:
+                current["count"] += measures["count"]
+                current["total"] += measures["total"]
+                current["min"] = min(current["min"], measures["min"])
+                current["max"] = max(current["max"], measures["max"])
+
+
+def reset() -> None:
+    with __lock:
+        __timers.clear()
+        __counters.clear()
+        __distributions.clear()
+        __profile.clear()
+
+
+def capture(function: Callable, *args) -> Tuple[Any, Dict]:
+    """
+    Call a function in a worker process and return its result with the measures it took,
+    for the parent process to `merge`. The measures inherited from the parent are dropped
+    first, so they are not counted twice.
+
+    Example:
+    >>> result, measures = executor.submit(capture, parse, path).result()
+    >>> merge(measures)
+    """
+    reset()
+    result = function(*args)
+    return result, snapshot()
+
+
+@contextmanager
+def profile(output_path: str, top: int = 20) -> Iterator[None]:
+    """
+    Profile a block with cProfile and tracemalloc. The cProfile statistics are saved to
+    `output_path` (readable with `pstats` or snakeviz), and the functions with the largest
+    cumulative time, the lines that allocated the most memory and the peak of traced memory
+    are added to the summary. Only the current process is profiled.
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        memory = tracemalloc.take_snapshot().statistics("lineno")[:top]
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        profiler.dump_stats(output_path)
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        with __lock:
+            __profile.update({
+                "path": output_path,
+                "functions": [
+                    {"function": f"{file}:{line}({name})", "calls": calls, "total": total, "cumulative": cumulative}
+                    for (file, line, name), (_, calls, total, cumulative, _) in functions
+                ],
+                "memory_peak_mb": peak / (1024 * 1024),
+                "memory": [
+                    {"line": str(statistic.traceback), "size_mb": statistic.size / (1024 * 1024), "blocks": statistic.count}
+                    for statistic in memory
+                ],
+            })
+        logging.info("INSTRUMENTATION - Saved profile as %s", output_path)
+
+
+def summary() -> Dict:
+    """
+    All measures taken so far, with the mean of every timer and distribution.
+    """
+    measures = snapshot()
+    for timer_measures in measures["timers"].values():
+        timer_measures["mean_wall"] = timer_measures["wall"] / timer_measures["calls"]
+    for distribution in measures["distributions"].values():
+        distribution["mean"] = distribution["total"] / distribution["count"]
+    with __lock:
+        if __profile:
+            measures["profile"] = dict(__profile)
+    return measures
+
+
+def write_summary(output_path: str) -> None:
+    """
+    Log the timers and counters, and save the whole `summary` as a JSON file.
+    """
+    measures = summary()
+    for name, timer_measures in sorted(measures["timers"].items(), key=lambda item: -item[1]["wall"]):
+        logging.info("INSTRUMENTATION - %s: %d calls, %.3f s wall, %.3f s CPU",
+                     name, timer_measures["calls"], timer_measures["wall"], timer_measures["cpu"])
+    for name, value in sorted(measures["counters"].items()):
+        logging.info("INSTRUMENTATION - %s: %d", name, value)
+    for name, distribution in sorted(measures["distributions"].items()):
+        logging.info("INSTRUMENTATION - %s: mean %.1f, min %g, max %g",
+                     name, distribution["mean"], distribution["min"], distribution["max"])
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump(measures, file, indent=2)
+    logging.info("INSTRUMENTATION - Saved summary as %s", output_path)
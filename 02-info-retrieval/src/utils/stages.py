@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterable, List, Optional
+
+import utils.instrumentation
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def __update_with_file(digest, path: str) -> None:
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+
+def content_hash(paths: Iterable[str]) -> str:
+    """
+    Hash the content of files and directories.
+
+    A directory is hashed through the relative path and content of every file under it, so
+    renaming, adding or removing a file changes its hash. A missing path hashes to a marker,
+    so it is told apart from an empty file.
+
+    Args:
+        paths (Iterable[str]): The files and directories to hash, in order.
+
+    Returns:
+        str: The SHA-256 hex digest of all of them.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        path = path.strip()
+        digest.update(f"\0{path}\0".encode("utf-8"))
+        if os.path.isdir(path):
+            for root, directories, files in os.walk(path):
+                directories.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    digest.update(f"\0{os.path.relpath(file_path, path)}\0".encode("utf-8"))
+                    __update_with_file(digest, file_path)
+        elif os.path.isfile(path):
+            __update_with_file(digest, path)
+        else:
+            digest.update(b"\0missing\0")
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Runs the stages of the pipeline only when they are out of date.
+
+    A stage is recorded in a JSON state file with the content hash of its inputs (data,
+    configuration files and source code), the hash of its parameters and the content hash
+    of its outputs. It is skipped when none of them changed since it last ran, so editing a
+    metric only runs the evaluation again, while editing the collection runs the indexer and
+    every stage after it, since their inputs are the outputs of the stages before them.
+
+    Example:
+    >>> stages = StageCache("./data/parsed/estagios.json")
+    >>> stages.run("pc", parse_queries, inputs=["./config/pc.cfg", "./data/raw/cfquery.xml"],
+    ...            outputs=["./data/parsed/consultas-NOSTEEMER.csv"])
+    """
+
+    def __init__(self, state_path: str, force: Optional[Iterable[str]] = None):
+        """
+        Args:
+            state_path (str): The path to the JSON state file.
+            force (Optional[Iterable[str]]): The stages to run even when they are up to date.
+                An empty iterable forces every stage, and None forces none.
+        """
+        self.state_path = state_path
+        self.force = None if force is None else set(force)
+        self.state = {}
+        if os.path.isfile(state_path):
+            with open(state_path, "r", encoding="utf-8") as file:
+                self.state = json.load(file)
+
+    def __forced(self, name: str) -> bool:
+        return self.force is not None and (not self.force or name in self.force)
+
+    def __save(self) -> None:
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        temporary_path = self.state_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(self.state, file, sort_keys=True, indent=2)
+        os.replace(temporary_path, self.state_path)
+
+    def run(self, name: str, function: Callable[[], None], inputs: List[str], outputs: List[str], params: Dict = None) -> bool:
+        """
+        Run a stage unless its outputs are up to date.
+
+        Args:
+            name (str): The name of the stage.
+            function (Callable[[], None]): Runs the stage.
+            inputs (List[str]): The files and directories the stage reads.
+            outputs (List[str]): The files and directories the stage writes.
+            params (Dict): The options of the stage that change its outputs.
+
+        Returns:
+            bool: Whether the stage ran.
+        """
+        fingerprint = {
+            "inputs": content_hash(inputs),
+            "params": hashlib.sha256(json.dumps(params or {}, sort_keys=True).encode("utf-8")).hexdigest(),
+        }
+        record = self.state.get(name)
+        if not self.__forced(name) and record is not None \
+                and {key: record.get(key) for key in fingerprint} == fingerprint \
+                and all(os.path.exists(output.strip()) for output in outputs) \
+                and record.get("outputs") == content_hash(outputs):
+            logging.info("STAGES - Skipping %s, its outputs are up to date", name)
+            utils.instrumentation.count("stages skipped")
+            return False
+
+        logging.info("STAGES - Running %s", name)
+        with utils.instrumentation.timer(f"stage {name}"):
+            function()
+        self.state[name] = dict(fingerprint, outputs=content_hash(outputs))
+        self.__save()
+        return True
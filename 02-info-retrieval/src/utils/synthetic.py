@@ -0,0 +1,114 @@
+import logging
+import os
+import re
+from typing import List, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+import parsers.reader
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+LETTERS = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+
+
+def __synthetic_words(n: int, rng: np.random.Generator) -> List[str]:
+    """
+    Invent `n` distinct lowercase words, 6 to 12 letters long, for the tail of the vocabulary.
+    """
+    words = set()
+    while len(words) < n:
+        lengths = rng.integers(6, 13, size=n)
+        words.update("".join(rng.choice(LETTERS, size=length)) for length in lengths)
+    return sorted(words)[:n]
+
+
+def __source_statistics(source_paths: List[str]) -> Tuple[List[str], np.ndarray]:
+    """
+    The words of a real collection, most frequent first, and the length in words of each
+    of its abstracts.
+    """
+    frequencies = {}
+    lengths = []
+    for source_path in source_paths:
+        for record in parsers.reader.read_records(source_path.strip()):
+            words = WORD_PATTERN.findall(record.text.lower())
+            lengths.append(len(words))
+            for word in words:
+                frequencies[word] = frequencies.get(word, 0) + 1
+    vocabulary = sorted(frequencies, key=lambda word: (-frequencies[word], word))
+    return vocabulary, np.asarray(lengths)
+
+
+def write_collection(output_path: str, source_paths: List[str], n_documents: int, n_queries: int = 100, vocabulary_size: int = 50000, documents_per_file: int = 10000, seed: int = 0) -> Tuple[List[str], str]:
+    """
+    Generate a synthetic collection in the format of the CFC collection, to benchmark the
+    system at sizes the real collection cannot reach.
+
+    The words of the abstracts follow a Zipf distribution over the words of a real collection,
+    ranked by frequency and extended with invented words up to `vocabulary_size`, and their
+    lengths are drawn from the lengths of the real abstracts. Each query is a handful of words
+    taken from one document, which is its only relevant record.
+
+    The same arguments always generate the same collection.
+
+    Args:
+    - output_path (str): the directory where the XML files are written
+    - source_paths (List[str]): the XML files of the real collection the statistics come from
+    - n_documents (int): how many RECORDs to generate
+    - n_queries (int): how many QUERYs to generate
+    - vocabulary_size (int): how many distinct words the abstracts are drawn from
+    - documents_per_file (int): how many RECORDs are written to each XML file
+    - seed (int): the seed of the random generator
+
+    Returns:
+    - Tuple[List[str], str]: the paths to the documents files and the path to the queries file
+
+    Example:
+    >>> documents_paths, queries_path = write_collection("./data/synthetic", ["./data/raw/cf74.xml"], 100000)
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary, lengths = __source_statistics(source_paths)
+    if vocabulary_size > len(vocabulary):
+        vocabulary += __synthetic_words(vocabulary_size - len(vocabulary), rng)
+    vocabulary = np.asarray(vocabulary[:vocabulary_size])
+    probabilities = 1 / np.arange(1, len(vocabulary) + 1)
+    probabilities /= probabilities.sum()
+
+    os.makedirs(output_path, exist_ok=True)
+    logging.info("SYNTHETIC - Writing %d documents and %d queries with %d words to %s",
+                 n_documents, n_queries, len(vocabulary), output_path)
+    query_sources = set(rng.choice(n_documents, size=min(n_queries, n_documents), replace=False).tolist())
+    queries = []
+    documents_paths = []
+    for first in range(0, n_documents, documents_per_file):
+        documents_path = os.path.join(output_path, f"synthetic{len(documents_paths):05d}.xml")
+        documents_paths.append(documents_path)
+        n_file_documents = min(documents_per_file, n_documents - first)
+        file_lengths = np.maximum(rng.choice(lengths, size=n_file_documents), 1)
+        words = vocabulary[rng.choice(len(vocabulary), size=int(file_lengths.sum()), p=probabilities)]
+        bounds = np.concatenate(([0], np.cumsum(file_lengths)))
+        with open(documents_path, "w", encoding="utf-8") as file:
+            file.write('<?xml version="1.0"?>\n<FILE>\n')
+            for i in range(n_file_documents):
+                record_num = first + i + 1
+                abstract = words[bounds[i]:bounds[i + 1]]
+                file.write(f"\t<RECORD>\n\t\t<RECORDNUM>{record_num:05d} </RECORDNUM>\n"
+                           f"\t\t<ABSTRACT>{escape(' '.join(abstract))}</ABSTRACT>\n\t</RECORD>\n")
+                if first + i in query_sources:
+                    n_words = min(len(abstract), int(rng.integers(3, 9)))
+                    queries.append((record_num, rng.choice(abstract, size=n_words, replace=False)))
+            file.write("</FILE>\n")
+
+    queries_path = os.path.join(output_path, "synthetic-queries.xml")
+    with open(queries_path, "w", encoding="utf-8") as file:
+        file.write('<?xml version="1.0"?>\n<FILEQUERY>\n')
+        for query_number, (record_num, words) in enumerate(queries, start=1):
+            file.write(f"\t<QUERY>\n\t\t<QueryNumber>{query_number:05d}</QueryNumber>\n"
+                       f"\t\t<QueryText>{escape(' '.join(words))}</QueryText>\n"
+                       f"\t\t<Results>00001</Results>\n\t\t<Records>\n"
+                       f"\t\t\t<Item score=\"2222\">{record_num}</Item>\n\t\t</Records>\n\t</QUERY>\n")
+        file.write("</FILEQUERY>\n")
+    return documents_paths, queries_path